@@ -0,0 +1,148 @@
+# apimo_cli.py
+"""
+Ligne de commande du moteur apimo_core, pour les scripts et le cron.
+
+    export APIMO_FTP_PASSWORD=...
+    python apimo_cli.py verify 1005 1006
+    python apimo_cli.py --site figaro add 1005 --contact-mode 1
+    cut -d, -f1 agences.csv | python apimo_cli.py --json remove -
+    python apimo_cli.py batch lot.xlsx
+
+Les fichiers sont téléchargés une seule fois par exécution (et pas du tout s'ils
+n'ont pas changé depuis le miroir local ; verify lit d'abord l'index serveur) ;
+ajout, suppression et modification passent par le traitement par lot : chaque
+fichier est envoyé une seule fois, quel que soit le nombre d'ID. Une ligne de résultat par ID et par site sur la
+sortie standard (JSON avec --json), les messages sur la sortie d'erreur.
+Code de retour : 0 si tout a réussi, 1 si une ligne a échoué (suppression ou
+modification d'un ID introuvable sur tous les sites demandés), 2 si la connexion
+ou les arguments sont invalides.
+"""
+
+import argparse
+import ftplib
+import getpass
+import json
+import os
+import sys
+
+import apimo_core as core
+
+PASSWORD_ENV = "APIMO_FTP_PASSWORD"
+ACTIONS = {'add': 'Ajouter', 'remove': 'Supprimer', 'modify': 'Modifier'}
+FAILED_RESULTS = ("Ligne invalide", "Échec")
+MISSING_RESULT = "Introuvable"  # échec seulement si l'ID n'est trouvé sur aucun site
+
+def read_ids(values):
+    """ID passés en argument ; « - » (ou aucun ID avec une entrée redirigée) lit un ID par ligne sur l'entrée standard."""
+    if not values and not sys.stdin.isatty(): values = ['-']
+    for value in values:
+        if value == '-':
+            for line in sys.stdin:
+                line = line.strip()
+                if line and not line.startswith('#'): yield line.split(',', 1)[0].strip()
+        else:
+            yield value
+
+def get_password():
+    password = os.environ.get(PASSWORD_ENV)
+    if password: return password
+    if not sys.stdin.isatty():  # entrée standard réservée aux ID
+        print(f"Mot de passe FTP absent : définir {PASSWORD_ENV}.", file=sys.stderr)
+        return None
+    return getpass.getpass("Mot de passe FTP : ")
+
+def print_message(level, message):
+    if level in ('warning', 'error'): print(f"[{level}] {message.replace('**', '')}", file=sys.stderr)
+
+def emit(row, as_json):
+    if as_json: print(json.dumps(row, ensure_ascii=False), flush=True)
+    else: print("\t".join(str(value) for value in row.values()), flush=True)
+
+def verify(snapshot, agency_ids, sites, as_json):
+    ok = True
+    for agency_id in agency_ids:
+        for site in sites:
+            found = core.check_id_for_site(snapshot, agency_id, site)
+            status = core.coherence_status(found)
+            ok = ok and status in ('cohérent', 'absent')
+            files = [{'fichier': path, 'mode': mode} for path, mode in found]
+            emit({'agency_id': agency_id, 'site': core.SITE_DISPLAY_NAMES[site], 'statut': status,
+                  'fichiers': files if as_json else " ".join(f"{f['fichier']}({f['mode']})" for f in files)}, as_json)
+    return ok
+
+def apply_rows(snapshot, rows, split_policy, as_json):
+    results = core.appliquer_lot(snapshot, rows, split_policy)
+    found = {(result['agency_id'], result['action']) for result in results if not result['résultat'].startswith(MISSING_RESULT)}
+    ok = True
+    for result in results:
+        missing = result['résultat'].startswith(MISSING_RESULT) and (result['agency_id'], result['action']) not in found
+        ok = ok and not missing and not result['résultat'].startswith(FAILED_RESULTS)
+        emit(result, as_json)
+    return ok
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gestion des flux Apimo en ligne de commande.")
+    parser.add_argument('--site', choices=list(core.SITES) + ['all'], default='all', help="Site(s) concerné(s) (par défaut : tous).")
+    parser.add_argument('--json', action='store_true', help="Une ligne JSON par résultat.")
+    parser.add_argument('--offline', action='store_true', help="verify : lecture du miroir local seul, sans connexion.")
+    parser.add_argument('--host', default=core.FTP_HOST)
+    parser.add_argument('--port', type=int, default=21)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('verify', help="Présence et cohérence des ID.").add_argument('ids', nargs='*')
+    for name, help_text in (('add', "Ajout des ID."), ('remove', "Suppression des ID."), ('modify', "Changement du mode de contact.")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('ids', nargs='*')
+        if name != 'remove': command.add_argument('--contact-mode', choices=['0', '1'], required=True)
+        if name == 'add': command.add_argument('--split-policy', choices=list(core.SPLIT_POLICIES), default=core.DEFAULT_SPLIT_POLICY)
+    batch = commands.add_parser('batch', help="Fichier de lot CSV/XLSX (mêmes colonnes que l'interface).")
+    batch.add_argument('file')
+    batch.add_argument('--contact-mode', choices=['0', '1'], default='0', help="Mode par défaut des lignes qui n'en précisent pas.")
+    batch.add_argument('--split-policy', choices=list(core.SPLIT_POLICIES), default=core.DEFAULT_SPLIT_POLICY)
+    args = parser.parse_args(argv)
+
+    sites = list(core.SITES) if args.site == 'all' else [args.site]
+    core.set_event_sink(print_message)
+    rows = None
+    if args.command == 'batch':
+        try:
+            with open(args.file, 'rb') as f:
+                rows = core.read_batch_file(f, args.site if args.site != 'all' else 'tous', args.contact_mode)
+        except (OSError, ValueError) as e:
+            print(f"Fichier du lot illisible : {e}", file=sys.stderr)
+            return 2
+        sites = [code for code in core.SITES if any(code in (row['sites'] or []) for row in rows)]
+    elif args.command != 'verify':
+        contact_mode = getattr(args, 'contact_mode', '0')
+        rows = [{'agency_id': agency_id, 'sites': sites, 'action': ACTIONS[args.command], 'contact_mode': contact_mode}
+                for agency_id in read_ids(args.ids)]
+
+    index = core.AgencyIndex(core.FeedMirror(core.MIRROR_DIR))
+    if args.command == 'verify' and args.offline:
+        for key in (key for site in sites for key in core.SITE_FILES[site] if not index.has(key)):
+            print(f"[warning] {core.display_path(*key)} absent du miroir local", file=sys.stderr)
+        return 0 if verify(core.FeedSnapshot(None, index), list(read_ids(args.ids)), sites, args.json) else 1
+
+    password = get_password()
+    if password is None: return 2
+    pool = core.FTPPool(args.host, core.FTP_USER, password, port=args.port)
+    try:
+        ftp = pool.acquire()
+    except ftplib.all_errors as e:
+        print(f"La connexion FTP a échoué : {e}", file=sys.stderr)
+        return 2
+    try:
+        snapshot = core.FeedSnapshot(ftp, index, pool)
+        files = [key for site in sites for key in core.SITE_FILES[site]]
+        snapshot.prefetch(snapshot.use_sidecar(files) if args.command == 'verify' else files)
+        for (path, filename), error in snapshot.errors.items():
+            print(f"[warning] Lecture impossible de {core.display_path(path, filename)} : {error}", file=sys.stderr)
+        if args.command == 'verify': ok = verify(snapshot, read_ids(args.ids), sites, args.json)
+        else: ok = apply_rows(snapshot, rows, getattr(args, 'split_policy', core.DEFAULT_SPLIT_POLICY), args.json)
+        snapshot.publish_sidecar()
+    finally:
+        pool.release(ftp)
+        pool.close_all()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
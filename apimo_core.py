@@ -0,0 +1,2425 @@
+# apimo_core.py
+"""
+Moteur de gestion des flux Apimo, sans interface : connexions FTP, index et miroir
+des CSV, vérification, ajout, suppression, modification, lot, rééquilibrage et audit.
+Les messages destinés à l'opérateur passent par notify() (récepteur installé par
+l'application Streamlit ou la CLI) ; pandas et asyncio ne sont importés que par
+les fonctions qui en ont besoin, pour un démarrage rapide de la CLI.
+"""
+
+import contextvars
+import calendar
+import ftplib
+import functools
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import tomllib
+import threading
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# --- CONFIGURATION ET NUMÉRO DE VERSION ---
+APP_VERSION = "v1.35.0" # Session FTP économe en allers-retours (répertoire courant suivi, listes et capacités en cache)
+FTP_HOST = "ftp.figarocms.fr"
+FTP_USER = "apimo-auto-fab"
+FTP_MAX_CONNECTIONS = 4 # Connexions simultanées par session (pool + téléchargements parallèles)
+LISTING_TTL = 30 # Secondes pendant lesquelles une liste de répertoire (NLST) est réutilisée par les connexions d'un pool
+MIRROR_DIR = os.environ.get("APIMO_MIRROR_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".apimo_mirror"))
+MIRROR_MAX_AGE = 15 * 60 # Au-delà (secondes), le miroir local est signalé comme ancien
+WRITE_ATTEMPTS = 5 # Tentatives d'une écriture quand un autre opérateur modifie le même fichier
+STREAM_CHUNK_SIZE = 64 * 1024 # Bloc lu à la fois par une réécriture en flux : borne sa mémoire, quelle que soit la taille du CSV
+BUFFER_INDEX_AFTER = 16 # Recherches par octets sur un même fichier avant d'indexer ses positions (CLI sur de nombreux ID)
+WARMUP_INTERVAL = 120 # Secondes entre deux revalidations de fond des CSV d'une session
+WARMUP_IDLE_STOP = 15 * 60 # Arrêt du préchargement de fond après cette durée sans activité de la session
+CLOCK_UNKNOWN_MARGIN = 300 # Secondes : tant que le décalage d'horloge du serveur est inconnu, seul un MDTM plus ancien est tenu pour vérifié
+GROUP_COMMIT_WINDOW = 0.3 # Secondes pendant lesquelles les écritures des autres sessions rejoignent le même envoi
+SIDECAR_SUFFIX = ".idx.gz" # Index des agences d'un CSV tenu sur le serveur, à côté de lui (.<fichier>.idx.gz)
+PERF_LOG_PATH = os.environ.get("APIMO_PERF_LOG", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".apimo_perf.jsonl"))
+
+SITES_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sites.toml")
+
+def load_sites_config(path=SITES_CONFIG_PATH):
+    """
+    Lit la topologie des sites (sites.toml) : login, fichier Global, emplacement,
+    préfixe et nombre des fichiers scindés. Retourne (hash agence, {code: site}).
+    Les fichiers de chaque site sont listés Global d'abord, puis scindés 1..shards.
+    """
+    with open(path, 'rb') as f:
+        config = tomllib.load(f)
+    sites = {}
+    for code, site in config['sites'].items():
+        global_dir, _, global_file = site['global_path'].rpartition('/')
+        split_path, prefix, shards = site.get('split_path', '/'), site['split_prefix'], int(site['shards'])
+        sites[code] = {
+            'display_name': site.get('display_name', code),
+            'login': str(site['login']),
+            'split_path': split_path,
+            'split_prefix': prefix,
+            'shards': shards,
+            'files': [(global_dir or "/", global_file)] + [(split_path, f"{prefix}{i}.csv") for i in range(1, shards + 1)],
+        }
+    return config['agency_hash'], sites
+
+AGENCY_HASH, SITES = load_sites_config()
+SITE_LOGINS = {code: site['login'] for code, site in SITES.items()}
+SITE_DISPLAY_NAMES = {code: site['display_name'] for code, site in SITES.items()}
+SITE_FILES = {code: site['files'] for code, site in SITES.items()}
+ALL_SITES_LABEL = 'Les deux' if len(SITES) == 2 else 'Tous les sites'
+
+def display_path(path, filename):
+    return f"/{filename}" if path == "/" else f"{path}/{filename}"
+
+GLOBAL_PATHS = {display_path(*files[0]) for files in SITE_FILES.values()}
+
+def sites_for_choice(site_choice):
+    """Codes des sites correspondant au choix de l'interface (nom affiché ou ALL_SITES_LABEL)."""
+    if site_choice == ALL_SITES_LABEL: return list(SITES)
+    return [code for code, name in SITE_DISPLAY_NAMES.items() if name == site_choice]
+
+# --- MESSAGES À L'OPÉRATEUR ---
+
+logger = logging.getLogger("apimo")
+_event_sink = contextvars.ContextVar('apimo_event_sink', default=None)
+_LOG_LEVELS = {'error': logging.ERROR, 'warning': logging.WARNING}
+
+def set_event_sink(sink):
+    """
+    Installe le récepteur des messages pour le contexte courant et les threads qu'il
+    lance : sink(niveau, message), niveau parmi info, success, warning, error, write,
+    caption. Sans récepteur, les messages vont au logger « apimo ».
+    """
+    return _event_sink.set(sink)
+
+def notify(level, message):
+    sink = _event_sink.get()
+    if sink is not None: sink(level, message)
+    else: logger.log(_LOG_LEVELS.get(level, logging.INFO), message)
+
+# --- TRAÇAGE DES COMMANDES FTP ---
+
+_current_trace = contextvars.ContextVar('ftp_trace', default=None)
+_current_function = contextvars.ContextVar('ftp_trace_function', default=None)
+TRACED_FILE_COMMANDS = {'RETR', 'STOR', 'APPE', 'SIZE', 'MDTM', 'DELE', 'RNFR', 'RNTO'} # Seul leur argument est consigné (jamais PASS)
+
+class FTPTrace:
+    """
+    Commandes FTP d'une exécution : durée, octets échangés, fichier concerné et
+    fonction de l'outil qui les a émises. Alimentée par TracedFTP tant qu'elle est
+    active (_current_trace), y compris depuis les threads du pool et du moteur asynchrone.
+    """
+    def __init__(self, action):
+        self.action = action
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{threading.get_ident() % 10000:04d}"
+        self.started = time.time()
+        self.duration = None
+        self.events = []
+        self._lock = threading.Lock()
+
+    def record(self, command, path, filename, duration, bytes_in, bytes_out):
+        event = {'function': _current_function.get() or '-', 'command': command, 'path': path, 'file': filename,
+                 'ms': round(duration * 1000, 2), 'bytes_in': bytes_in, 'bytes_out': bytes_out}
+        with self._lock: self.events.append(event)
+
+    def stop(self):
+        self.duration = time.time() - self.started
+
+    def frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.events, columns=['function', 'command', 'path', 'file', 'ms', 'bytes_in', 'bytes_out'])
+
+    def by_function(self):
+        """Nombre, durée cumulée et octets par fonction et par commande."""
+        return (self.frame().groupby(['function', 'command'], as_index=False)
+                .agg(appels=('ms', 'size'), ms=('ms', 'sum'), octets_recus=('bytes_in', 'sum'), octets_envoyes=('bytes_out', 'sum'))
+                .sort_values('ms', ascending=False))
+
+    def by_file(self):
+        """Mêmes totaux par fichier (commandes portant sur un fichier uniquement)."""
+        frame = self.frame()
+        frame = frame[frame['file'] != '']
+        frame = frame.assign(fichier=[display_path(path or '/', filename) for path, filename in zip(frame['path'], frame['file'])])
+        return (frame.groupby(['fichier', 'command'], as_index=False)
+                .agg(appels=('ms', 'size'), ms=('ms', 'sum'), octets_recus=('bytes_in', 'sum'), octets_envoyes=('bytes_out', 'sum'))
+                .sort_values(['fichier', 'ms'], ascending=[True, False]))
+
+    def write_jsonl(self, path=PERF_LOG_PATH):
+        """Ajoute une ligne JSON par commande au journal, avec l'identifiant et l'action de l'exécution."""
+        run = {'run_id': self.run_id, 'app_version': APP_VERSION, 'action': self.action,
+               'started_at': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)), 'run_s': round(self.duration or 0, 3)}
+        with open(path, 'a', encoding='utf-8') as f:
+            for event in self.events: f.write(json.dumps({**run, **event}, ensure_ascii=False) + "\n")
+
+def start_trace(action):
+    """Active une trace pour la suite du contexte courant (et les threads qu'il lance)."""
+    trace = FTPTrace(action)
+    return trace, _current_trace.set(trace)
+
+def stop_trace(trace, token):
+    _current_trace.reset(token)
+    trace.stop()
+
+def traced(func):
+    """Les commandes FTP émises pendant func sont regroupées sous son nom dans la trace."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_function.set(func.__name__)
+        try: return func(*args, **kwargs)
+        finally: _current_function.reset(token)
+    return wrapper
+
+class _CountingReader:
+    """Enveloppe du fichier envoyé par storbinary, qui compte les octets lus."""
+    def __init__(self, fp, counts):
+        self.fp, self.counts = fp, counts
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.counts[1] += len(data)
+        return data
+
+class SessionCache:
+    """
+    État partagé par les connexions d'un pool : listes de répertoires (NLST) gardées
+    `ttl` secondes, capacités du serveur apprises en cours de route (APPE refusé :
+    plus tenté par les opérations suivantes), décalage de son horloge et nombre
+    d'allers-retours évités.
+    """
+    def __init__(self, ttl=LISTING_TTL):
+        self.ttl = ttl
+        self.listings = {}      # (répertoire, arguments) -> (heure, noms)
+        self.capabilities = {}  # commande -> bool
+        self.clock_skew = None  # horloge locale - horloge serveur, surestimé ; None tant qu'aucune écriture ne l'a appris
+        self.clock_probed = False  # sonde d'horloge (_learn_clock) déjà tentée
+        self._skew_bound = float('inf')
+        self.saved = 0
+        self._lock = threading.Lock()
+        self.clock_lock = threading.Lock()  # une seule sonde à la fois pour le pool
+
+    def observe_clock(self, modified_at, written=False):
+        """
+        MDTM (secondes UTC) lu à l'instant : l'écart avec l'horloge locale borne le
+        décalage par le haut. Seul le MDTM de notre propre écriture, tout juste faite,
+        l'apprend ; les autres ne font que l'abaisser (serveur en avance).
+        """
+        skew = time.time() - modified_at
+        with self._lock:
+            self._skew_bound = min(self._skew_bound, skew)
+            if written or self.clock_skew is not None: self.clock_skew = self._skew_bound
+
+    def server_time(self):
+        """Heure du serveur estimée, jamais en avance sur la vraie ; décalage inconnu : CLOCK_UNKNOWN_MARGIN de retard."""
+        return time.time() - (self.clock_skew if self.clock_skew is not None else CLOCK_UNKNOWN_MARGIN)
+
+    def count(self, round_trips=1):
+        with self._lock: self.saved += round_trips
+
+    def listing(self, key):
+        with self._lock:
+            cached = self.listings.get(key)
+            if cached is None or time.monotonic() - cached[0] > self.ttl: return None
+            self.saved += 1
+            return list(cached[1])
+
+    def store_listing(self, key, names):
+        with self._lock: self.listings[key] = (time.monotonic(), list(names))
+
+    def invalidate(self):
+        """Fichier créé, renommé ou supprimé : les listes en cache ne sont plus sûres."""
+        with self._lock: self.listings.clear()
+
+class TracedFTP(ftplib.FTP_TLS):
+    """
+    FTP_TLS qui consigne chaque commande dans la trace active. Seul l'appel le plus
+    externe est mesuré : un RETR inclut son TYPE I, son PASV et le transfert.
+    Suit aussi le répertoire courant : un CWD vers le répertoire où la connexion se
+    trouve déjà n'est pas envoyé, et NLST passe par le cache de session du pool.
+    """
+    _depth = 0
+    _path = ''
+    _dir = None  # répertoire courant (absolu) confirmé par le serveur, None si inconnu
+
+    def __init__(self, *args, cache=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache if cache is not None else SessionCache()
+
+    def _traced(self, line, call, counts=None):
+        trace = _current_trace.get()
+        if trace is None or self._depth: return call()
+        command, _, arg = line.partition(' ')
+        command = command.upper()
+        counts = counts if counts is not None else [0, 0]
+        self._depth += 1
+        started = time.perf_counter()
+        try:
+            return call()
+        finally:
+            self._depth -= 1
+            filename = arg.strip() if command in TRACED_FILE_COMMANDS else ''
+            trace.record(command, self._joined(arg) if command == 'CWD' else self._path, filename, time.perf_counter() - started, *counts)
+
+    def _joined(self, dirname):
+        """Chemin consigné après un CWD vers dirname."""
+        return (dirname.strip('/') or '/') if dirname.startswith('/') or self._path in ('', '/') else f"{self._path}/{dirname}"
+
+    def connect(self, *args, **kwargs):
+        return self._traced('CONNECT', lambda: super(TracedFTP, self).connect(*args, **kwargs))
+
+    def sendcmd(self, cmd):
+        return self._traced(cmd, lambda: super(TracedFTP, self).sendcmd(cmd))
+
+    def voidcmd(self, cmd):
+        return self._traced(cmd, lambda: super(TracedFTP, self).voidcmd(cmd))
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        counts = [0, 0]
+        def counting(data):
+            counts[0] += len(data)
+            callback(data)
+        return self._traced(cmd, lambda: super(TracedFTP, self).retrbinary(cmd, counting, blocksize, rest), counts)
+
+    def retrlines(self, cmd, callback=None):
+        counts = [0, 0]
+        callback = callback or print
+        def counting(line):
+            counts[0] += len(line) + 1
+            callback(line)
+        return self._traced(cmd, lambda: super(TracedFTP, self).retrlines(cmd, counting), counts)
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None, rest=None):
+        counts = [0, 0]
+        self.cache.invalidate()
+        return self._traced(cmd, lambda: super(TracedFTP, self).storbinary(cmd, _CountingReader(fp, counts), blocksize, callback, rest), counts)
+
+    def cwd(self, dirname):
+        target = dirname if dirname.startswith('/') else None
+        if target is not None and target == self._dir:
+            self.cache.count()
+            return '250 Répertoire courant inchangé'
+        self._dir = None
+        response = super().cwd(dirname)
+        self._dir, self._path = target, self._joined(dirname)  # suivi avec ou sans trace active
+        return response
+
+    def nlst(self, *args):
+        key = (self._dir, args)
+        names = self.cache.listing(key) if self._dir is not None else None
+        if names is None:
+            names = super().nlst(*args)
+            if self._dir is not None: self.cache.store_listing(key, names)
+        return names
+
+    def rename(self, fromname, toname):
+        self.cache.invalidate()
+        return super().rename(fromname, toname)
+
+    def delete(self, filename):
+        self.cache.invalidate()
+        return super().delete(filename)
+
+# --- FONCTIONS TECHNIQUES FTP ---
+
+def _open_ftp(host, user, password, port=21, cache=None):
+    """Ouvre une connexion FTP_TLS authentifiée (cache : SessionCache du pool). Lève ftplib.all_errors en cas d'échec."""
+    ftp = TracedFTP(timeout=60, cache=cache)
+    ftp.connect(host, port)
+    ftp.sendcmd('USER ' + user)
+    ftp.sendcmd('PASS ' + password)
+    return ftp
+
+class FTPPool:
+    """
+    Pool de connexions FTP authentifiées (conservé dans la session Streamlit,
+    ou le temps d'une commande pour la CLI).
+    Les connexions libres sont maintenues par NOOP, vérifiées avant chaque prêt,
+    rouvertes si le serveur les a coupées et fermées après max_idle secondes.
+    """
+    def __init__(self, host, user, password, max_size=FTP_MAX_CONNECTIONS, max_idle=300, keepalive=45, port=21):
+        self.host, self.user, self.password, self.port = host, user, password, port
+        self.max_size = max_size
+        self.max_idle, self.keepalive = max_idle, keepalive
+        self._idle = []  # [(ftp, horodatage dernier usage)]
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._keepalive_thread = None
+        self.cache = SessionCache()
+
+    @staticmethod
+    def _is_alive(ftp):
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except (*ftplib.all_errors, AttributeError):
+            return False
+
+    @staticmethod
+    def _close(ftp):
+        try: ftp.quit()
+        except Exception:
+            try: ftp.close()
+            except Exception: pass
+
+    def acquire(self):
+        """Prête une connexion saine (réutilisée ou nouvelle)."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle: break
+                    ftp, _ = self._idle.pop()
+                if self._is_alive(ftp): return ftp
+                self._close(ftp)
+            return _open_ftp(self.host, self.user, self.password, self.port, self.cache)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, ftp, discard=False):
+        """Rend une connexion au pool. discard=True la ferme (état inconnu après erreur)."""
+        try:
+            if discard:
+                self._close(ftp)
+                return
+            with self._lock:
+                self._idle.append((ftp, time.monotonic()))
+                self._start_keepalive()
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except BaseException:
+            self.release(ftp, discard=True)
+            raise
+        self.release(ftp)
+
+    def _start_keepalive(self):
+        # Appelé sous verrou. Le thread s'arrête de lui-même quand le pool est vide.
+        if self._keepalive_thread is None or not self._keepalive_thread.is_alive():
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while True:
+            time.sleep(self.keepalive)
+            with self._lock:
+                if not self._idle: return
+                now, kept = time.monotonic(), []
+                for ftp, last_used in self._idle:
+                    if now - last_used > self.max_idle or not self._is_alive(ftp):
+                        self._close(ftp)
+                    else:
+                        kept.append((ftp, last_used))
+                self._idle = kept
+
+    def close_all(self):
+        with self._lock:
+            for ftp, _ in self._idle: self._close(ftp)
+            self._idle = []
+
+# --- INDEX DES AGENCES ET INSTANTANÉ DES FICHIERS ---
+
+def parse_contact_mode(line):
+    parts = line.split(',')
+    return parts[-1] if len(parts) >= 5 else '?'
+
+ID_INDENT = b' \t' # Espaces ignorés devant l'ID : une ligne est à l'agence si, sans eux, elle commence par « id, »
+
+def _line_id(line):
+    """ID d'une ligne de CSV (texte) : avant la première virgule, espaces de tête ignorés (ID_INDENT)."""
+    return line.lstrip(' \t').split(',', 1)[0]
+
+def _id_pattern(agency_id):
+    """Regex des lignes de l'agence (précédées de \\n), avec ou sans espaces de tête (ID_INDENT)."""
+    return re.compile(rb'\n[ \t]*' + re.escape(str(agency_id).encode('utf-8')) + rb',')
+
+class FeedBuffer:
+    """
+    Contenu brut d'un CSV (octets, fins de ligne \\n). L'agence est cherchée dans le
+    tampon (b"\\n" + id + b",", ou par un index des positions si des lignes ont des
+    espaces de tête) et seule la ligne trouvée est décodée ; suppression et
+    modification recollent des plages d'octets sans découper le fichier en lignes.
+    Les lignes décodées (lines()) ne sont produites qu'à la demande, sans être gardées ;
+    lot, audit et rééquilibrage passent par FeedColumns. Immuable : chaque retouche
+    retourne un nouveau tampon.
+    """
+    __slots__ = ('data', '_offsets', '_searches')
+
+    def __init__(self, data=b''):
+        data = bytes(data)
+        self.data = data.replace(b'\r\n', b'\n') if b'\r' in data else data
+        self._offsets = None  # (hash des ID triés, débuts de ligne), construit après BUFFER_INDEX_AFTER recherches
+        self._searches = 0
+
+    @classmethod
+    def from_lines(cls, lines):
+        return cls("\n".join(lines).encode('utf-8'))
+
+    def lines(self):
+        """Lignes non vides, décodées à chaque appel : rien n'est gardé sur le tampon, partagé par l'index du processus."""
+        return [line.strip() for line in self.data.decode('utf-8', errors='ignore').splitlines() if line.strip()]
+
+    @property
+    def line_count(self):
+        data = self.data
+        return data.count(b'\n') + (1 if data and not data.endswith(b'\n') else 0)
+
+    def _line_end(self, start):
+        end = self.data.find(b'\n', start)
+        return len(self.data) if end < 0 else end
+
+    def _indented(self):
+        """Vrai si une ligne commence par un espace ID_INDENT (la recherche directe des octets ne la trouverait pas)."""
+        data = self.data
+        return data[:1] in (b' ', b'\t') or any(b'\n' + bytes([space]) in data for space in ID_INDENT)
+
+    def _build_offsets(self):
+        """
+        Index des positions : hash de l'ID de chaque ligne (int64) trié, avec le début
+        de la ligne (int32 sous 2 Go), soit 12 octets par ligne quel que soit l'ID.
+        Un hash ne fait que désigner des candidates, vérifiées dans les octets.
+        """
+        import numpy as np
+        matches = re.finditer(rb'^[ \t]*([^,\n]*),', self.data, re.M)
+        pairs = np.fromiter(((hash(match.group(1)), match.start()) for match in matches), dtype=np.dtype((np.int64, 2)))
+        order = np.argsort(pairs[:, 0], kind='stable')
+        self._offsets = pairs[order, 0], pairs[order, 1].astype(np.int32 if len(self.data) < 2**31 else np.int64)
+
+    def _starts(self, agency_id):
+        """Débuts des lignes de l'agence (voir ID_INDENT), dans l'ordre du fichier."""
+        data, prefix = self.data, agency_id.encode('utf-8') + b','
+        if self._offsets is None:
+            self._searches += 1
+            if self._searches > BUFFER_INDEX_AFTER or (self._searches == 1 and self._indented()): self._build_offsets()
+        if self._offsets is not None:
+            import numpy as np
+            hashes, starts = self._offsets
+            key, line = hash(prefix[:-1]), re.compile(rb'[ \t]*' + re.escape(prefix))
+            candidates = starts[np.searchsorted(hashes, key, 'left'):np.searchsorted(hashes, key, 'right')].tolist()
+            return sorted(start for start in candidates if line.match(data, start))
+        starts = [0] if data.startswith(prefix) else []
+        needle = b'\n' + prefix
+        position = data.find(needle)
+        while position >= 0:
+            starts.append(position + 1)
+            position = data.find(needle, position + 1)
+        return starts
+
+    def find(self, agency_id):
+        """(position en octets, mode_contact) de la première ligne de l'agence, ou None."""
+        starts = self._starts(str(agency_id))
+        if not starts: return None
+        line = self.data[starts[0]:self._line_end(starts[0])].decode('utf-8', errors='ignore').strip()
+        return starts[0], parse_contact_mode(line)
+
+    def _splice(self, replacements):
+        """Nouveau tampon où chaque plage (début, fin) est remplacée par ses octets."""
+        view, pieces, previous = memoryview(self.data), [], 0
+        for start, end, data in replacements:
+            start = max(start, previous)  # plages qui se chevauchent : reprise à la fin de la précédente
+            pieces.append(view[previous:start])
+            pieces.append(data)
+            previous = end
+        pieces.append(view[previous:])
+        return FeedBuffer(b''.join(pieces))
+
+    def without(self, agency_id):
+        """(tampon sans les lignes de l'agence, nombre de lignes retirées)."""
+        starts = self._starts(str(agency_id))
+        if not starts: return self, 0
+        # La ligne part avec son \\n (ou le \\n qui précède la série de lignes retirées en fin de fichier)
+        spans = []
+        for start in starts:
+            end = self._line_end(start)
+            if end < len(self.data):
+                spans.append((start, end + 1, b''))
+                continue
+            while spans and spans[-1][1] == start: start = spans.pop()[0]
+            spans.append((max(start - 1, 0), end, b''))
+        return self._splice(spans), len(starts)
+
+    def with_contact_mode(self, agency_id, contact_mode):
+        """(tampon où les lignes de l'agence ont le nouveau mode, au moins une ligne modifiée ?)."""
+        spans = []
+        for start in self._starts(str(agency_id)):
+            end = self._line_end(start)
+            parts = self.data[start:end].rstrip().split(b',')
+            if len(parts) >= 5:
+                spans.append((start, end, b','.join(parts[:4] + [str(contact_mode).encode('utf-8')])))
+        return (self._splice(spans), True) if spans else (self, False)
+
+    def appended(self, records):
+        """Tampon avec les lignes ajoutées en fin de fichier (comme un APPE)."""
+        separator = b'' if not self.data or self.data.endswith(b'\n') else b'\n'
+        return FeedBuffer(self.data + separator + "\n".join(records).encode('utf-8'))
+
+LINE_BREAKS = (b'\r', b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\xc2\x85', b'\xe2\x80\xa8', b'\xe2\x80\xa9')  # autres fins de ligne de str.splitlines
+
+def _canonical_id(agency_id):
+    """agency_id en entier s'il s'écrit tel quel en décimal (sans zéro de tête), sinon None."""
+    text = str(agency_id)
+    if text.isascii() and text.isdigit() and len(text) <= 18 and (text == '0' or text[0] != '0'): return int(text)
+    return None
+
+class FeedColumns:
+    """
+    CSV décomposé en colonnes pour les traitements sur tout le fichier (lot, audit) :
+    agency_id en int64, mode de contact en uint8 et colonnes constantes (login, hash,
+    type) encodées par dictionnaire. Les lignes hors format (ID avec zéro de tête,
+    nombre de champs inattendu, espaces...) sont gardées octet pour octet à part.
+    Les lignes retirées sont seulement masquées (alive) : les n° de ligne restent
+    stables. to_bytes() reproduit le CSV à l'identique (lignes jointes par \\n), sauf
+    les lignes vides, retirées ; un fichier avec d'autres fins de ligne que \\n est lu
+    comme FeedBuffer.lines().
+    """
+    def __init__(self, size=0):
+        import numpy as np
+        self.ids = np.full(size, -1, dtype=np.int64)  # -1 : ID hors format, voir irregular
+        self.modes = np.zeros(size, dtype=np.uint8)
+        self.codes = np.zeros(size, dtype=np.uint32)  # indice dans categories ("login,hash,type")
+        self.alive = np.ones(size, dtype=bool)
+        self.categories = []
+        self.irregular = {}  # n° de ligne -> ligne complète (texte)
+        self.size = size
+        self.count = size
+        self.nbytes = 0
+        self._order = None   # tri des ids[:_ordered], construit à la première recherche
+        self._ordered = 0
+        self._recent = {}    # ID -> n° des lignes ajoutées depuis le tri
+
+    @classmethod
+    def parse(cls, feed):
+        """Colonnes d'un FeedBuffer (ou d'une liste de lignes, ou None) ; seules les lignes hors format passent par Python."""
+        import numpy as np
+        data = b'' if feed is None else feed.data if isinstance(feed, FeedBuffer) else "\n".join(feed).encode('utf-8')
+        if any(separator in data for separator in LINE_BREAKS): data = "\n".join(FeedBuffer(data).lines()).encode('utf-8')
+        raw = np.frombuffer(data, dtype=np.uint8)
+        ends = np.concatenate([np.flatnonzero(raw[n:n + (1 << 23)] == 10) + n for n in range(0, len(raw), 1 << 23)] + [np.zeros(0, dtype=np.int64)])
+        if data and not data.endswith(b'\n'): ends = np.append(ends, len(data))
+        ends = ends.astype(np.int32 if len(raw) < 2**31 else np.int64)  # positions : 4 octets par ligne suffisent
+        starts = np.zeros_like(ends)
+        starts[1:] = ends[:-1] + 1
+        starts, ends = starts[ends > starts], ends[ends > starts]
+        columns = cls(len(starts))
+        if not len(starts): return columns
+
+        # Format attendu : id,login,hash,type,mode (id décimal sans zéro de tête, mode sur un chiffre)
+        last = len(raw) - 1
+        ids, id_length = np.zeros(len(starts), dtype=np.int64), np.zeros_like(starts)
+        reading, regular = np.ones(len(starts), dtype=bool), np.ones(len(starts), dtype=bool)
+        for k in range(19):
+            byte = raw[np.minimum(starts + k, last)]
+            inside = reading & (starts + k < ends)
+            digit = inside & (byte - 48 <= 9)  # uint8 : tout octet hors '0'-'9' dépasse 9
+            stopped = reading & ~digit
+            id_length[stopped] = k
+            regular[stopped & ~(inside & (byte == 44))] = False  # l'ID se termine par une virgule
+            ids = np.where(digit, ids * 10 + (byte.astype(np.int64) - 48), ids)
+            reading &= digit
+            if not reading.any(): break
+        regular &= ~reading & (id_length >= 1) & ((raw[starts] != 48) | (id_length == 1))
+        middle_start, middle_end = starts + id_length + 1, ends - 2
+        regular &= (middle_end > middle_start) & (raw[np.maximum(middle_end, 0)] == 44) & (raw[ends - 1] - 48 <= 9)
+
+        # Colonnes constantes : chaque valeur distincte comparée par blocs à toutes les lignes restantes
+        pending, table = np.flatnonzero(regular), {}
+        while len(pending) and len(table) < 16:
+            reference = data[middle_start[pending[0]]:middle_end[pending[0]]]
+            same = (middle_end[pending] - middle_start[pending]) == len(reference)
+            candidates, expected = np.flatnonzero(same), np.frombuffer(reference, dtype=np.uint8)
+            for n in range(0, len(candidates), 16384):
+                block = candidates[n:n + 16384]
+                same[block] = (raw[middle_start[pending[block]][:, None] + np.arange(len(reference))] == expected).all(axis=1)
+            columns.codes[pending[same]] = table.setdefault(reference, len(table))
+            pending = pending[~same]
+        for row in pending.tolist():
+            columns.codes[row] = table.setdefault(data[middle_start[row]:middle_end[row]], len(table))
+        columns.categories = [key.decode('utf-8', errors='ignore') for key in table]
+        odd = [code for code, middle in enumerate(columns.categories) if middle.count(',') != 2]
+        if odd: regular &= ~np.isin(columns.codes, odd)
+
+        rows = np.flatnonzero(regular)
+        columns.ids[rows] = ids[rows]
+        columns.modes[rows] = raw[ends[rows] - 1] - 48
+        columns.nbytes = int((ends[rows] - starts[rows] + 1).sum())
+        for row, start, end in zip(np.flatnonzero(~regular).tolist(), starts[~regular].tolist(), ends[~regular].tolist()):
+            line = data[start:end].decode('utf-8', errors='ignore')
+            if not line.strip():
+                columns.alive[row] = False
+                columns.count -= 1
+                continue
+            columns.irregular[row] = line
+            agency_id = _canonical_id(_line_id(line))
+            if agency_id is not None: columns.ids[row] = agency_id
+            columns.nbytes += len(line.encode('utf-8')) + 1
+        return columns
+
+    def _rows(self, rows):
+        import numpy as np
+        rows = np.asarray(rows)
+        return np.flatnonzero(rows) if rows.dtype == bool else rows.astype(np.int64)
+
+    def rows(self, agency_id):
+        """N° des lignes présentes de l'agence, dans l'ordre du fichier (dichotomie sur les ID triés)."""
+        import numpy as np
+        value = _canonical_id(agency_id)
+        if value is None:
+            found = [row for row, line in self.irregular.items() if _line_id(line) == str(agency_id)]
+        else:
+            if self._order is None:
+                self._order, self._ordered, self._recent = np.argsort(self.ids[:self.size], kind='stable'), self.size, {}
+            ids = self.ids[:self._ordered]
+            found = self._order[np.searchsorted(ids, value, 'left', sorter=self._order):np.searchsorted(ids, value, 'right', sorter=self._order)].tolist()
+            found += self._recent.get(value, [])
+        return sorted(row for row in found if self.alive[row])
+
+    def mask(self, agency_ids):
+        """Masque des lignes présentes dont l'ID figure dans agency_ids (np.isin)."""
+        import numpy as np
+        agency_ids = [str(agency_id) for agency_id in agency_ids]
+        values = [value for value in map(_canonical_id, agency_ids) if value is not None]
+        found = np.isin(self.ids[:self.size], np.array(values, dtype=np.int64)) & self.alive[:self.size]
+        others = set(agency_ids)
+        for row, line in self.irregular.items():
+            if _line_id(line) in others: found[row] = self.alive[row]
+        return found
+
+    def line(self, row):
+        if row in self.irregular: return self.irregular[row]
+        return f"{self.ids[row]},{self.categories[self.codes[row]]},{self.modes[row]}"
+
+    def _format(self, rows):
+        categories, irregular = self.categories, self.irregular
+        return [irregular[row] if row in irregular else f"{agency_id},{categories[code]},{mode}"
+                for row, agency_id, code, mode in zip(rows.tolist(), self.ids[rows].tolist(), self.codes[rows].tolist(), self.modes[rows].tolist())]
+
+    def lines(self):
+        import numpy as np
+        return self._format(np.flatnonzero(self.alive[:self.size]))
+
+    def to_bytes(self, chunk=65536):
+        """Contenu CSV des lignes présentes, formaté par blocs de chunk lignes."""
+        import numpy as np
+        rows = np.flatnonzero(self.alive[:self.size])
+        return b"\n".join("\n".join(self._format(rows[n:n + chunk])).encode('utf-8') for n in range(0, len(rows), chunk))
+
+    def drop(self, rows):
+        """Masque les lignes (n° ou masque booléen). Retourne le nombre de lignes retirées."""
+        rows = [row for row in self._rows(rows).tolist() if self.alive[row]]
+        for row in rows: self.nbytes -= len(self.line(row).encode('utf-8')) + 1
+        self.alive[rows] = False
+        self.count -= len(rows)
+        return len(rows)
+
+    def set_mode(self, rows, contact_mode):
+        """Change le mode de contact des lignes d'au moins 5 champs. Retourne le nombre de lignes modifiées."""
+        contact_mode = str(contact_mode)
+        rows, changed = self._rows(rows), 0
+        vectorized = contact_mode.isascii() and contact_mode.isdigit() and len(contact_mode) == 1
+        for row in rows.tolist():
+            if row not in self.irregular and vectorized: continue
+            parts = self.line(row).split(',')
+            if len(parts) < 5: continue
+            line = f"{parts[0]},{parts[1]},{parts[2]},{parts[3]},{contact_mode}"
+            self.nbytes += len(line.encode('utf-8')) - len(self.line(row).encode('utf-8'))
+            self.irregular[row] = line
+            changed += 1
+        if vectorized:
+            regular = [row for row in rows.tolist() if row not in self.irregular]
+            self.modes[regular] = int(contact_mode)
+            changed += len(regular)
+        return changed
+
+    def append(self, line):
+        """Ajoute une ligne en fin de fichier (capacité doublée au besoin). Retourne son n°."""
+        import numpy as np
+        if self.size == len(self.ids):
+            extra = max(16, self.size)
+            self.ids = np.concatenate((self.ids, np.full(extra, -1, dtype=np.int64)))
+            self.modes = np.concatenate((self.modes, np.zeros(extra, dtype=np.uint8)))
+            self.codes = np.concatenate((self.codes, np.zeros(extra, dtype=np.uint32)))
+            self.alive = np.concatenate((self.alive, np.zeros(extra, dtype=bool)))
+        row, parts = self.size, line.split(',')
+        agency_id = _canonical_id(_line_id(line))
+        if len(parts) == 5 and agency_id is not None and len(parts[4]) == 1 and parts[4].isascii() and parts[4].isdigit() and line == line.strip():
+            middle = ','.join(parts[1:4])
+            if middle not in self.categories: self.categories.append(middle)
+            self.codes[row], self.modes[row] = self.categories.index(middle), int(parts[4])
+        else:
+            self.irregular[row] = line
+        self.ids[row] = -1 if agency_id is None else agency_id
+        self.alive[row] = True
+        if agency_id is not None: self._recent.setdefault(agency_id, []).append(row)
+        self.size += 1
+        self.count += 1
+        self.nbytes += len(line.encode('utf-8')) + 1
+        return row
+
+    def frame(self):
+        """DataFrame (rang, agency_id, contact_mode) des lignes présentes, pour l'audit vectorisé."""
+        import numpy as np
+        import pandas as pd
+        rows = np.flatnonzero(self.alive[:self.size])
+        agency_ids = self.ids[rows]
+        contact_modes = np.array(list("0123456789") + ['?'] * 246, dtype=object)[self.modes[rows]]
+        irregular = [(int(np.searchsorted(rows, row)), line) for row, line in self.irregular.items() if self.alive[row]]
+        if any(agency_ids[n] < 0 for n, _ in irregular): agency_ids = agency_ids.astype(object)
+        for n, line in irregular:
+            if agency_ids[n] == -1: agency_ids[n] = _line_id(line)
+            contact_modes[n] = line.rsplit(',', 1)[-1].strip() if line.count(',') >= 4 else '?'
+        return pd.DataFrame({'rang': rows, 'agency_id': agency_ids, 'contact_mode': contact_modes})
+
+class FeedMirror:
+    """
+    Copie locale persistante des CSV, partagée par toutes les sessions et conservée
+    entre les redémarrages de Streamlit. Pour chaque fichier : son contenu, son
+    empreinte serveur (MDTM, SIZE) et l'heure de la dernière vérification sur le serveur.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def _paths(self, key):
+        path, filename = key
+        folder = self.directory if path == "/" else os.path.join(self.directory, path.strip("/"))
+        return os.path.join(folder, filename), os.path.join(folder, filename + ".meta.json")
+
+    @staticmethod
+    def _write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if isinstance(content, str): content = content.encode('utf-8')
+        with open(tmp, 'wb') as f: f.write(content)
+        os.replace(tmp, path)
+
+    def load(self, key):
+        """(empreinte, FeedBuffer, heure de vérification, empreinte vérifiée?), ou None si le fichier n'est pas en miroir."""
+        data_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path, encoding='utf-8') as f: meta = json.load(f)
+            verified = meta.get('verified', False)  # miroir antérieur : relu une fois
+            if meta['stamp'] is None: return None, None, meta['checked_at'], verified
+            with open(data_path, 'rb') as f: return tuple(meta['stamp']), FeedBuffer(f.read()), meta['checked_at'], verified
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, key, stamp, buffer, verified=True):
+        data_path, meta_path = self._paths(key)
+        with self._lock:
+            try:
+                if buffer is not None: self._write(data_path, buffer.data)
+                self._write(meta_path, json.dumps({'stamp': stamp, 'checked_at': time.time(), 'verified': verified}))
+            except OSError:
+                pass  # Le miroir n'est qu'un cache : une écriture ratée ne bloque pas l'opération
+
+    def discard(self, key):
+        with self._lock:
+            for path in self._paths(key):
+                try: os.remove(path)
+                except OSError: pass
+
+    def touch(self, key, stamp):
+        """Enregistre que le serveur a confirmé l'empreinte sans que le contenu change."""
+        _, meta_path = self._paths(key)
+        with self._lock:
+            try: self._write(meta_path, json.dumps({'stamp': stamp, 'checked_at': time.time(), 'verified': True}))
+            except OSError: pass
+
+class AgencyIndex:
+    """
+    Index des CSV conservé entre les reruns : pour chaque fichier, son empreinte
+    serveur (MDTM, SIZE) et son contenu brut (FeedBuffer), dans lequel les agences
+    sont cherchées directement. Une empreinte non vérifiée (contenu lu ou écrit dans
+    la seconde de son MDTM, voir _settled) ne permet pas de réutiliser le contenu.
+    Avec un miroir, l'index est amorcé depuis le disque et chaque mise à jour y est recopiée.
+    Un seul index par processus (cache_resource côté Streamlit), partagé par les
+    sessions, leurs préchargements et WriteCoordinator : une entrée n'est jamais
+    modifiée, seulement remplacée, et chaque FeedSnapshot garde celle qu'il a lue.
+    """
+    def __init__(self, mirror=None):
+        self.files = {}       # (chemin, fichier) -> {'stamp', 'buffer', 'verified'}
+        self.checked_at = {}  # (chemin, fichier) -> heure de la dernière confirmation par le serveur
+        self.mirror = mirror
+        self._lock = threading.Lock()  # entrée et miroir changés ensemble
+
+    def _seed(self, key):
+        if key in self.files or self.mirror is None: return
+        with self._lock:
+            if key in self.files: return
+            cached = self.mirror.load(key)
+            if cached is not None:
+                self.files[key] = {'stamp': cached[0], 'buffer': cached[1], 'verified': cached[3]}
+                self.checked_at[key] = cached[2]
+
+    def entry(self, key):
+        """Entrée courante du fichier ({'stamp', 'buffer', 'verified'}), None s'il n'est pas indexé."""
+        self._seed(key)
+        return self.files.get(key)
+
+    def stamp(self, key):
+        self._seed(key)
+        entry = self.files.get(key)
+        return entry['stamp'] if entry else None
+
+    def known_stamp(self, key):
+        """Empreinte dont le contenu peut être réutilisé sans relecture, None si absente ou non vérifiée."""
+        self._seed(key)
+        entry = self.files.get(key)
+        return entry['stamp'] if entry and entry['verified'] else None
+
+    def has(self, key):
+        self._seed(key)
+        return key in self.files
+
+    def touch(self, key, stamp):
+        """Le serveur a confirmé stamp ; sans effet si l'entrée a été remplacée entre-temps."""
+        with self._lock:
+            entry = self.files.get(key)
+            if entry is None or entry['stamp'] != stamp: return
+            self.checked_at[key] = time.time()
+            if self.mirror is not None: self.mirror.touch(key, stamp)
+
+    def age(self, keys):
+        """Secondes depuis la plus ancienne confirmation par le serveur parmi keys."""
+        return time.time() - min(self.checked_at.get(key, 0) for key in keys)
+
+    def update_file(self, key, stamp, buffer, verified=True):
+        """Remplace le contenu d'un seul fichier (buffer None : fichier absent) ; les autres entrées restent intactes. Retourne la nouvelle entrée."""
+        entry = {'stamp': stamp, 'buffer': buffer, 'verified': verified}
+        with self._lock:
+            self.files[key] = entry
+            self.checked_at[key] = time.time()
+            if self.mirror is not None: self.mirror.save(key, stamp, buffer, verified)
+        return entry
+
+    def forget(self, key):
+        """Oublie le fichier (contenu réécrit sans être gardé) : il sera relu à la prochaine opération."""
+        with self._lock:
+            self.files.pop(key, None)
+            self.checked_at.pop(key, None)
+            if self.mirror is not None: self.mirror.discard(key)
+
+def _cwd(ftp, path):
+    """Un seul CWD absolu, et aucun si la connexion est déjà dans le répertoire (TracedFTP)."""
+    ftp.cwd("/" + path.strip("/"))
+
+def _remote_stamp(ftp, filename):
+    """(MDTM, SIZE) du fichier dans le répertoire courant, None s'il n'existe pas."""
+    try:
+        mdtm = ftp.sendcmd(f'MDTM {filename}').split()[-1]
+    except ftplib.error_perm:
+        return None
+    try:
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(filename)
+    except ftplib.error_perm:
+        size = None
+    return (mdtm, size)
+
+def _mdtm_epoch(mdtm):
+    """Réponse MDTM (AAAAMMJJHHMMSS[.fff], UTC) en secondes, None si illisible."""
+    try:
+        return calendar.timegm(time.strptime(mdtm[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+
+def _learn_clock(ftp):
+    """
+    Apprend le décalage d'horloge du pool par une écriture : fichier vide envoyé dans
+    le répertoire courant, son MDTM lu, puis supprimé. Une seule tentative par pool ;
+    si le serveur la refuse, le décalage reste inconnu (CLOCK_UNKNOWN_MARGIN).
+    """
+    cache = ftp.cache
+    with cache.clock_lock:
+        if cache.clock_skew is not None or cache.clock_probed: return
+        cache.clock_probed = True
+        name = f".apimo-clock.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            ftp.storbinary(f'STOR {name}', io.BytesIO(b''))
+            try: modified_at = _mdtm_epoch(ftp.sendcmd(f'MDTM {name}').split()[-1])
+            finally: ftp.delete(name)
+        except ftplib.all_errors:
+            return
+        if modified_at is not None: cache.observe_clock(modified_at, written=True)
+
+def _settled(ftp, stamp):
+    """
+    Vrai si l'empreinte identifie le contenu lu à l'instant : MDTM antérieur à la
+    seconde précédente du serveur. Deux écritures de même taille dans la même seconde
+    (mode 0 <-> 1) donnent la même empreinte ; un contenu lu ou écrit dans la seconde
+    de son MDTM n'est donc pas vérifiable par elle. L'heure du serveur suppose son
+    décalage appris (_learn_clock), sinon une marge prudente.
+    """
+    if stamp is None: return True
+    modified_at = _mdtm_epoch(stamp[0])
+    if modified_at is None: return False
+    if ftp.cache.clock_skew is None: _learn_clock(ftp)
+    ftp.cache.observe_clock(modified_at)
+    return modified_at < int(ftp.cache.server_time()) - 1
+
+def _settle(ftp, filename, attempts=3):
+    """
+    (empreinte, vérifiée?) du fichier dans le répertoire courant, après avoir attendu
+    (2 s au plus à chaque fois) que sa dernière écriture sorte de la seconde en cours :
+    toute écriture ultérieure changera alors MDTM.
+    """
+    stamp = _remote_stamp(ftp, filename)
+    for _ in range(attempts):
+        if _settled(ftp, stamp): return stamp, True
+        if _mdtm_epoch(stamp[0]) is None or ftp.cache.clock_skew is None: break  # attendre ne suffirait pas
+        time.sleep(min(max(_mdtm_epoch(stamp[0]) + 2 - ftp.cache.server_time(), 0.05), 2))
+        stamp = _remote_stamp(ftp, filename)
+    return stamp, _settled(ftp, stamp)
+
+def fetch_feed(ftp, path, filename, known_stamp=None):
+    """
+    Télécharge un CSV si son empreinte serveur diffère de known_stamp.
+    Retourne (empreinte, FeedBuffer, téléchargé?, empreinte vérifiée?) ; empreinte
+    None si le fichier est absent.
+    """
+    _cwd(ftp, path)
+    stamp = _remote_stamp(ftp, filename)
+    if stamp is None: return None, None, False, True
+    if stamp == known_stamp: return stamp, None, False, True
+    verified = _settled(ftp, stamp)
+    r = io.BytesIO()
+    try:
+        ftp.retrbinary(f'RETR {filename}', r.write)
+    except ftplib.error_perm:
+        return None, None, True, True
+    return stamp, FeedBuffer(r.getbuffer()), True, verified
+
+class _AgencyFound(Exception):
+    """Interrompt retrbinary dès que la ligne de l'agence a été reçue."""
+
+def _abort_transfer(ftp):
+    """
+    Resynchronise le canal de commande après un transfert coupé côté client : ABOR puis
+    NOOP, en lisant les réponses en attente (426, 225, 226 selon les serveurs) jusqu'à
+    celle du NOOP. Lève ftplib.error_proto si elle ne vient pas.
+    """
+    ftp.putcmd('ABOR')
+    ftp.putcmd('NOOP')
+    for _ in range(5):
+        if ftp.getmultiline().startswith('200'): return
+    raise ftplib.error_proto("Canal de commande désynchronisé après ABOR")
+
+def scan_feed(ftp, path, filename, known_stamp, agency_id):
+    """
+    fetch_feed pour un test d'existence : le CSV est parcouru au fil des blocs reçus
+    (une ligne peut chevaucher deux blocs) et le transfert interrompu dès la première
+    ligne de l'agence. Retourne (empreinte, FeedBuffer ou None si interrompu,
+    téléchargé?, empreinte vérifiée?, ligne de l'agence si interrompu).
+    """
+    _cwd(ftp, path)
+    stamp = _remote_stamp(ftp, filename)
+    if stamp is None: return None, None, False, True, None
+    if stamp == known_stamp: return stamp, None, False, True, None
+    verified = _settled(ftp, stamp)
+    pattern = _id_pattern(agency_id)
+    received, found = bytearray(b"\n"), []  # \n initial : la première ligne se cherche comme les autres
+    def on_chunk(chunk):
+        start = received.rfind(b"\n")  # dernière ligne, peut-être incomplète : cherchée à nouveau avec le bloc reçu
+        received.extend(chunk)
+        if not found:
+            match = pattern.search(received, start)
+            if match: found.append(match.start() + 1)
+        if found and received.find(b"\n", max(found[0], start)) >= 0: raise _AgencyFound
+    try:
+        ftp.retrbinary(f'RETR {filename}', on_chunk)
+    except _AgencyFound:
+        _abort_transfer(ftp)
+        line = received[found[0]:received.index(b"\n", found[0])]
+        return stamp, None, True, verified, line.decode('utf-8', errors='ignore').strip()
+    except ftplib.error_perm:
+        return None, None, True, True, None
+    return stamp, FeedBuffer(memoryview(received)[1:]), True, verified, None
+
+class _LineStream:
+    """
+    Callback de retrbinary : les lignes reçues bloc par bloc sont passées à edit_line
+    et écrites dans out, rejointes par \\n. Seule la ligne coupée en fin de bloc est
+    gardée en mémoire.
+    """
+    def __init__(self, edit_line, out):
+        self.edit_line, self.out = edit_line, out
+        self.tail = b""        # début de la dernière ligne reçue, complétée par le bloc suivant
+        self.separator = b""   # \\n devant chaque ligne gardée sauf la première
+        self.changed = 0
+
+    def _edit(self, lines):
+        for line in lines:
+            edited = self.edit_line(line)
+            if edited is not line: self.changed += 1
+            if edited is None: continue
+            self.out.write(self.separator + edited)
+            self.separator = b"\n"
+
+    def __call__(self, chunk):
+        *lines, self.tail = (self.tail + chunk).split(b"\n")
+        self._edit([line[:-1] if line.endswith(b"\r") else line for line in lines])  # \\r\\n lu comme \\n (FeedBuffer)
+
+    def close(self):
+        self._edit([self.tail])
+
+def stream_edit(ftp, filename, tmp_name, edit_line):
+    """
+    Réécriture en flux sur une seule connexion, dans le répertoire du fichier : le RETR
+    de filename est filtré ligne par ligne vers un fichier temporaire local, envoyé
+    ensuite sous tmp_name (STOR) s'il a changé. edit_line(ligne en octets, sans fin de
+    ligne) retourne la nouvelle ligne, None pour la retirer, ou la ligne elle-même
+    (même objet) si elle n'est pas concernée. Même résultat que les retouches de
+    FeedBuffer ; au-delà de STREAM_CHUNK_SIZE le contenu est sur disque, jamais en
+    mémoire. Retourne (lignes changées, octets envoyés) ; 0 ligne : rien n'a été envoyé.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=STREAM_CHUNK_SIZE) as spool:
+        stream = _LineStream(edit_line, spool)
+        ftp.retrbinary(f'RETR {filename}', stream, blocksize=STREAM_CHUNK_SIZE)
+        stream.close()
+        if not stream.changed: return 0, 0
+        size = spool.tell()
+        spool.seek(0)
+        ftp.storbinary(f'STOR {tmp_name}', spool, blocksize=STREAM_CHUNK_SIZE)
+        return stream.changed, size
+
+def _line_without(agency_id):
+    """edit_line de stream_edit qui retire les lignes de l'agence (comme FeedBuffer.without)."""
+    prefix = f"{agency_id},".encode('utf-8')
+    return lambda line: None if line.lstrip(ID_INDENT).startswith(prefix) else line
+
+def _line_with_contact_mode(agency_id, contact_mode):
+    """edit_line de stream_edit qui change le mode de contact de l'agence (comme FeedBuffer.with_contact_mode)."""
+    prefix, mode = f"{agency_id},".encode('utf-8'), str(contact_mode).encode('utf-8')
+    def edit(line):
+        if not line.lstrip(ID_INDENT).startswith(prefix): return line
+        parts = line.rstrip().split(b',')
+        return b','.join(parts[:4] + [mode]) if len(parts) >= 5 else line
+    return edit
+
+def sidecar_name(filename):
+    return f".{filename}{SIDECAR_SUFFIX}"
+
+class SidecarIndex:
+    """
+    Index compact d'un CSV tenu sur le serveur dans son répertoire (sidecar_name,
+    texte compressé) : l'empreinte MDTM/SIZE du CSV indexé puis une ligne « id,mode »
+    par agence. Une vérification à froid ne télécharge que ces petits fichiers ; un
+    index dont l'empreinte n'est plus celle du CSV, ou n'est pas encore vérifiable
+    (voir _settled), est ignoré et le CSV téléchargé comme avant. Chaque ajout,
+    suppression ou modification republie l'index du CSV écrit (FeedSnapshot._upload_sidecar).
+    """
+    def __init__(self, stamp, body=b"\n"):
+        self.stamp = stamp  # empreinte du CSV indexé
+        self.body = body    # b"\nid,mode\n..."
+
+    @classmethod
+    def decode(cls, data):
+        """Lève zlib.error ou ValueError si le contenu est illisible."""
+        text = zlib.decompress(data)
+        start = text.index(b'\n')
+        mdtm, size = text[1:start].decode('utf-8').split('|')
+        return cls((mdtm, int(size) if size else None), text[start:])
+
+    def encode(self):
+        mdtm, size = self.stamp
+        return zlib.compress(f"#{mdtm}|{'' if size is None else size}".encode('utf-8') + self.body)
+
+    @classmethod
+    def from_buffer(cls, stamp, buffer):
+        """Index du CSV d'après son contenu (colonnes agency_id et mode de FeedColumns)."""
+        frame = FeedColumns.parse(buffer).frame()
+        pairs = "\n".join(f"{agency_id},{mode}" for agency_id, mode in zip(frame['agency_id'].tolist(), frame['contact_mode'].tolist()))
+        return cls(stamp, f"\n{pairs}\n".encode('utf-8') if pairs else b"\n")
+
+    def without(self, agency_id):
+        """Index sans les lignes de l'agence (comme _line_without sur le CSV)."""
+        pattern = rb'\n' + re.escape(str(agency_id).encode('utf-8')) + rb',[^\n]*'
+        return SidecarIndex(self.stamp, re.sub(pattern, b'', self.body))
+
+    def with_contact_mode(self, agency_id, contact_mode):
+        """Index avec le nouveau mode pour les lignes régulières de l'agence (comme _line_with_contact_mode)."""
+        pattern = rb'(\n' + re.escape(str(agency_id).encode('utf-8')) + rb',)(?!\?\n)[^\n]*'
+        return SidecarIndex(self.stamp, re.sub(pattern, lambda match: match.group(1) + str(contact_mode).encode('utf-8'), self.body))
+
+    def lookup(self, agency_id):
+        """Mode de contact de la première ligne de l'agence, ou None."""
+        needle = f"\n{agency_id},".encode('utf-8')
+        position = self.body.find(needle)
+        if position < 0: return None
+        start = position + len(needle)
+        return self.body[start:self.body.index(b'\n', start)].decode('utf-8')
+
+class WriteConflict(Exception):
+    """Le fichier a changé sur le serveur pendant chaque tentative d'écriture."""
+
+class FeedSnapshot:
+    """
+    Contenu des CSV pour une seule opération. Chaque fichier est téléchargé (RETR)
+    au plus une fois, et seulement si son empreinte MDTM/SIZE diffère de celle de
+    l'index (ftp=None : lecture seule depuis le miroir local, sans connexion).
+    Vérification, ajout, suppression et modification travaillent ensuite sur le
+    contenu en mémoire (FeedBuffer), tenu à jour après chaque écriture. L'index
+    pouvant être mis à jour par d'autres sessions, chaque fichier est lu dans l'entrée
+    retenue au chargement : les écritures comparent le serveur à cette version-là.
+    """
+    def __init__(self, ftp, index=None, pool=None):
+        self.ftp = ftp
+        self.index = index if index is not None else AgencyIndex()
+        self.pool = pool
+        self._loaded = {}            # (chemin, fichier) -> entrée de l'index lue par l'opération
+        self.errors = {}  # (chemin, fichier) -> exception de lecture
+        self.retr_count = 0
+        self.stor_count = 0
+        self.reused_count = 0
+        self.conflict_count = 0
+        self.sidecar_count = 0
+        self.partial_count = 0
+        self.appe_supported = ftp.cache.capabilities.get('APPE', True) if ftp is not None else True
+        self.sidecars = {}           # (chemin, fichier) -> SidecarIndex à jour lu sur le serveur, servi sans téléchargement
+        self._downloaded = set()     # fichiers téléchargés pendant l'opération : leur index serveur est republié
+        self._probes = {}            # (chemin, fichier) -> (agency_id, ligne) lue avant interruption du transfert
+
+    def _apply(self, key, stamp, buffer, downloaded, verified=True):
+        if downloaded: self.retr_count += 1
+        if buffer is not None: self._downloaded.add(key)
+        if stamp is not None and buffer is None:
+            entry = self.index.entry(key)
+            if entry is None or not entry['verified'] or entry['stamp'] != stamp:
+                # Entrée remplacée par une autre session depuis la comparaison : relecture complète
+                return self._apply(key, *fetch_feed(self.ftp, *key))
+            self.reused_count += 1
+            self.index.touch(key, stamp)
+        else:
+            entry = self.index.update_file(key, stamp, buffer, verified)
+        self._loaded[key] = entry
+        self.errors.pop(key, None)
+
+    def _apply_scan(self, key, agency_id, stamp, buffer, downloaded, verified, line):
+        """Résultat de scan_feed : fichier complet comme _apply, ou seule ligne de l'agence si interrompu."""
+        if line is None: return self._apply(key, stamp, buffer, downloaded, verified)
+        self.partial_count += 1
+        self._probes[key] = (str(agency_id), line)
+        self.errors.pop(key, None)
+
+    def _pending(self, files):
+        return [key for key in dict.fromkeys(files) if key not in self._loaded and key not in self.sidecars and key not in self._probes]
+
+    @traced
+    def prefetch(self, files, agency_id=None):
+        """
+        Charge en parallèle les fichiers pas encore chargés, chacun sur sa propre
+        connexion du pool (au plus pool.max_size à la fois). Avec agency_id, chaque
+        transfert s'arrête dès la ligne de l'agence (scan_feed). Les échecs sont
+        consignés par fichier dans self.errors.
+        """
+        todo = self._pending(files)
+        if not todo or self.pool is None or self.ftp is None: return
+        known = {key: self.index.known_stamp(key) for key in todo}  # lu ici : _apply vérifie que l'entrée n'a pas changé depuis
+        def work(key):
+            with self.pool.connection() as ftp:
+                return fetch_feed(ftp, *key, known[key]) if agency_id is None else scan_feed(ftp, *key, known[key], agency_id)
+        with ThreadPoolExecutor(max_workers=min(len(todo), self.pool.max_size)) as executor:
+            futures = {key: executor.submit(contextvars.copy_context().run, work, key) for key in todo}  # trace conservée dans les threads
+        for key, future in futures.items():
+            try:
+                if agency_id is None: self._apply(key, *future.result())
+                else: self._apply_scan(key, agency_id, *future.result())
+            except Exception as e:
+                self.errors[key] = e
+
+    def buffer(self, path, filename):
+        """Contenu brut du fichier (FeedBuffer), ou None s'il n'existe pas."""
+        key = (path, filename)
+        if key not in self._loaded and self.ftp is None:
+            # Mode hors ligne : lecture directe du miroir local, sans revalidation
+            entry = self.index.entry(key)
+            if entry is None:
+                self.errors[key] = FileNotFoundError("absent du miroir local")
+                raise self.errors[key]
+            self.reused_count += 1
+            self._loaded[key] = entry
+        if key not in self._loaded:
+            try:
+                self._apply(key, *fetch_feed(self.ftp, path, filename, self.index.known_stamp(key)))
+            except Exception as e:
+                self.errors[key] = e
+                raise
+        return self._loaded[key]['buffer']
+
+    def lines(self, path, filename):
+        """Lignes non vides du fichier, ou None s'il n'existe pas."""
+        buffer = self.buffer(path, filename)
+        return buffer.lines() if buffer is not None else None
+
+    def locate(self, path, filename, agency_id):
+        """
+        (position en octets, mode_contact) de l'agence dans le fichier, ou None. Recherche
+        dans les octets, ou dans l'index serveur (position None) si le fichier y est à jour.
+        """
+        key = (path, filename)
+        if key in self.sidecars and key not in self._loaded:
+            contact_mode = self.sidecars[key].lookup(agency_id)
+            return None if contact_mode is None else (None, contact_mode)
+        if key in self._probes and key not in self._loaded and self._probes[key][0] == str(agency_id):
+            return (None, parse_contact_mode(self._probes[key][1]))
+        buffer = self.buffer(path, filename)
+        return buffer.find(agency_id) if buffer is not None else None
+
+    def probe(self, path, filename, agency_id):
+        """locate pour un test d'existence : un fichier à télécharger est lu en flux et le transfert interrompu dès l'agence."""
+        key = (path, filename)
+        if self.ftp is not None and self._pending([key]):
+            try:
+                self._apply_scan(key, agency_id, *scan_feed(self.ftp, path, filename, self.index.known_stamp(key), agency_id))
+            except Exception as e:
+                self.errors[key] = e
+                raise
+        return self.locate(path, filename, agency_id)
+
+    def size(self, path, filename):
+        """Taille en octets d'après l'empreinte SIZE de l'index (taille du contenu à défaut)."""
+        buffer = self.buffer(path, filename)
+        stamp = self._loaded[(path, filename)]['stamp']
+        if stamp and stamp[1] is not None: return stamp[1]
+        return len(buffer.data) if buffer is not None else 0
+
+    def _reload(self, key):
+        """Conflit d'écriture : oublie la version lue pour qu'elle soit relue depuis le serveur."""
+        self._loaded.pop(key, None)
+        self.conflict_count += 1
+
+    def _unchanged_since_read(self, key):
+        """
+        Vrai si l'empreinte MDTM/SIZE du serveur est toujours celle de la version lue.
+        Version non vérifiable par l'empreinte (lue ou écrite dans la seconde de son
+        MDTM) : le fichier est relu une fois cette seconde passée et comparé octet par
+        octet ; s'il est identique, l'entrée de l'index est vérifiée.
+        """
+        entry = self._loaded[key]
+        _cwd(self.ftp, key[0])
+        stamp = _remote_stamp(self.ftp, key[1])
+        if stamp != entry['stamp']: return False
+        if stamp is None or entry['verified']: return True
+        stamp, verified = _settle(self.ftp, key[1])
+        if not verified or stamp is None: return False
+        current = io.BytesIO()
+        self.ftp.retrbinary(f'RETR {key[1]}', current.write)
+        self.retr_count += 1
+        buffer = entry['buffer']
+        if current.getbuffer() != buffer.data or _remote_stamp(self.ftp, key[1]) != stamp: return False
+        self._loaded[key] = self.index.update_file(key, stamp, buffer)
+        return True
+
+    def rewrite(self, path, filename, edit):
+        """
+        Écriture optimiste du fichier complet : edit(FeedBuffer lu) -> nouveau FeedBuffer
+        (ou liste de lignes).
+        Le contenu est envoyé sous un nom temporaire ; si l'empreinte du fichier a changé
+        depuis la lecture (autre opérateur), le temporaire est supprimé, le fichier relu
+        et edit rejouée, jusqu'à WRITE_ATTEMPTS fois. Sinon le temporaire remplace le
+        fichier par RNFR/RNTO : l'import Apimo ne lit jamais un fichier à moitié écrit.
+        Lève WriteConflict si le fichier change à chaque tentative.
+        """
+        key = (path, filename)
+        tmp_name = f".{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+        for _ in range(WRITE_ATTEMPTS):
+            edited = edit(self.buffer(path, filename) or FeedBuffer())
+            if not isinstance(edited, FeedBuffer): edited = FeedBuffer.from_lines(list(edited))
+            data = edited.data
+            _cwd(self.ftp, path)
+            self.ftp.storbinary(f'STOR {tmp_name}', io.BytesIO(data))
+            if not self._unchanged_since_read(key):
+                self.ftp.delete(tmp_name)
+                self._reload(key)
+                continue
+            self._swap_in(tmp_name, filename, data)
+            self.stor_count += 1
+            self._record_write(key, len(data), edited)
+            return edited
+        raise WriteConflict(f"{display_path(path, filename)} a été modifié par un autre opérateur à chaque tentative ({WRITE_ATTEMPTS}).")
+
+    def _record_write(self, key, size, buffer):
+        """
+        Après notre écriture : l'empreinte serveur n'est gardée avec buffer que si SIZE
+        est exactement celle attendue. Sinon un autre opérateur a écrit entre-temps et
+        le fichier est oublié, pour être relu au lieu d'écraser ses lignes plus tard.
+        """
+        stamp = _remote_stamp(self.ftp, key[1])
+        if stamp is None or stamp[1] != size:
+            self.index.forget(key)
+            self._loaded.pop(key, None)
+            return
+        modified_at = _mdtm_epoch(stamp[0])
+        if modified_at is not None: self.ftp.cache.observe_clock(modified_at, written=True)
+        self._loaded[key] = self.index.update_file(key, stamp, buffer, _settled(self.ftp, stamp))
+        self._downloaded.discard(key)
+        self._upload_sidecar(key, SidecarIndex.from_buffer(stamp, buffer))
+
+    def _swap_in(self, tmp_name, filename, data=None):
+        """Remplace filename par le temporaire déjà envoyé (RNFR/RNTO) dans le répertoire courant."""
+        try:
+            self.ftp.rename(tmp_name, filename)
+        except ftplib.error_perm:
+            # Serveur qui refuse d'écraser un fichier existant par RNTO : envoi direct,
+            # ou suppression puis renommage si le contenu n'est pas en mémoire (flux)
+            if data is None:
+                self.ftp.delete(filename)
+                self.ftp.rename(tmp_name, filename)
+                return
+            self.ftp.delete(tmp_name)
+            self.ftp.storbinary(f'STOR {filename}', io.BytesIO(data))
+
+    def is_loaded(self, path, filename):
+        """Vrai si le contenu complet du fichier est en mémoire pour cette opération."""
+        return (path, filename) in self._loaded
+
+    def stream_rewrite(self, path, filename, edit_line, edit_sidecar=None):
+        """
+        rewrite sans charger le fichier (agence trouvée par l'index serveur ou une lecture
+        interrompue) : stream_edit sur la connexion de l'opération, sans en prendre une
+        autre au pool, puis RNFR/RNTO si l'empreinte n'a pas changé depuis le début de
+        la lecture, sinon nouvel essai (WRITE_ATTEMPTS). Mémoire bornée par
+        STREAM_CHUNK_SIZE. Le contenu n'étant pas gardé, le fichier est oublié par
+        l'index et le miroir (relu à la prochaine opération). Retourne le nombre de
+        lignes changées ; lève WriteConflict si le fichier change à chaque tentative.
+        edit_sidecar(SidecarIndex) applique la même retouche à l'index serveur de la
+        version lue, republié avec l'empreinte écrite (s'il existait).
+        Seuls supprimer_client et modifier_client y passent, pour un fichier pas encore
+        en mémoire : les écritures regroupées (WriteCoordinator) et les fichiers déjà
+        chargés (préchargement) sont réécrits en mémoire par rewrite.
+        """
+        key = (path, filename)
+        tmp_name = f".{filename}.{os.getpid()}-{threading.get_ident()}.tmp"
+        for _ in range(WRITE_ATTEMPTS):
+            _cwd(self.ftp, path)
+            stamp, verified = _settle(self.ftp, filename)
+            if stamp is None: return 0
+            if not verified:
+                self.conflict_count += 1
+                continue
+            sidecar = self.sidecars.get(key)
+            if edit_sidecar is not None and (sidecar is None or sidecar.stamp != stamp): sidecar = self._read_sidecar(filename)
+            changed, size = stream_edit(self.ftp, filename, tmp_name, edit_line)
+            self.retr_count += 1
+            if not changed: return 0
+            if _remote_stamp(self.ftp, filename) != stamp:
+                self.ftp.delete(tmp_name)
+                self.conflict_count += 1
+                continue
+            self._swap_in(tmp_name, filename)
+            self.stor_count += 1
+            self.index.forget(key)
+            self._loaded.pop(key, None)
+            self._probes.pop(key, None)
+            self.sidecars.pop(key, None)
+            written = _remote_stamp(self.ftp, filename)
+            if edit_sidecar is not None and sidecar is not None and sidecar.stamp == stamp and written is not None and written[1] == size:
+                self._upload_sidecar(key, SidecarIndex(written, edit_sidecar(sidecar).body))
+            return changed
+        raise WriteConflict(f"{display_path(path, filename)} a été modifié par un autre opérateur à chaque tentative ({WRITE_ATTEMPTS}).")
+
+    def _tail(self, filename):
+        """(taille, finit par un saut de ligne?) : SIZE puis lecture du seul dernier octet (REST taille-1). Lève error_perm/error_reply si non supporté."""
+        self.ftp.voidcmd('TYPE I')
+        size = self.ftp.size(filename)
+        if size is None: raise ftplib.error_perm("500 SIZE indisponible")
+        if size == 0: return size, True
+        tail = io.BytesIO()
+        self.ftp.retrbinary(f'RETR {filename}', tail.write, rest=size - 1)
+        return size, tail.getvalue().endswith(b'\n')
+
+    def append(self, path, filename, records):
+        """
+        Ajoute des lignes en fin de fichier avec APPE : seuls les nouveaux enregistrements
+        sont transférés, quelle que soit la taille du fichier. L'empreinte serveur est
+        d'abord comparée à la version lue ; en cas de conflit le fichier est relu et les
+        agences ajoutées entre-temps par un autre opérateur ne sont pas renvoyées. Le
+        contenu en mémoire n'est gardé que si SIZE a augmenté exactement des octets envoyés.
+        Repli sur rewrite si le fichier n'existe pas encore ou si le serveur refuse
+        SIZE, REST ou APPE.
+        """
+        key = (path, filename)
+        for _ in range(WRITE_ATTEMPTS):
+            buffer = self.buffer(path, filename)
+            if buffer is None or not self.appe_supported: break
+            pending = [record for record in records if not buffer.find(record.split(',', 1)[0])]
+            if not pending: return
+            if not self._unchanged_since_read(key):
+                self._reload(key)
+                continue
+            try:
+                size, ends_with_newline = self._tail(filename)
+                payload = (('' if ends_with_newline else '\n') + "\n".join(pending)).encode('utf-8')
+                self.ftp.storbinary(f'APPE {filename}', io.BytesIO(payload))
+            except (ftplib.error_perm, ftplib.error_reply) as e:
+                if not str(e).startswith(('500', '501', '502', '504')): raise
+                self.appe_supported = self.ftp.cache.capabilities['APPE'] = False
+                break
+            self.stor_count += 1
+            self._record_write(key, size + len(payload), buffer.appended(pending))
+            return
+        else:
+            raise WriteConflict(f"{display_path(path, filename)} a été modifié par un autre opérateur à chaque tentative ({WRITE_ATTEMPTS}).")
+        def add_missing(buffer):
+            return buffer.appended([record for record in records if not buffer.find(record.split(',', 1)[0])])
+        self.rewrite(path, filename, add_missing)
+
+    def _read_sidecar(self, filename):
+        """Index serveur du CSV dans le répertoire courant, None s'il manque ou est illisible."""
+        data = io.BytesIO()
+        try:
+            self.ftp.retrbinary(f'RETR {sidecar_name(filename)}', data.write)
+            return SidecarIndex.decode(data.getvalue())
+        except (ftplib.error_perm, zlib.error, ValueError):
+            return None
+
+    @traced
+    def use_sidecar(self, files):
+        """
+        Vérification à froid : compare l'empreinte de chaque CSV à l'index local, puis,
+        s'il n'y est pas à jour, lit le seul index serveur de ce CSV. Les CSV à jour
+        nulle part restent à télécharger ; ils sont retournés (à passer à prefetch).
+        """
+        todo = [key for key in dict.fromkeys(files) if key not in self._loaded and key not in self.sidecars]
+        if self.ftp is None or not todo: return todo
+        remaining = []
+        for key in todo:
+            _cwd(self.ftp, key[0])
+            stamp = _remote_stamp(self.ftp, key[1])
+            if stamp is None or stamp == self.index.known_stamp(key):
+                self._apply(key, stamp, None, False)
+                continue
+            sidecar = self._read_sidecar(key[1])
+            if sidecar is not None and sidecar.stamp == stamp and _settled(self.ftp, stamp):
+                self.sidecars[key] = sidecar
+                self.sidecar_count += 1
+            else: remaining.append(key)
+        return remaining
+
+    def _upload_sidecar(self, key, sidecar):
+        """
+        Envoie l'index serveur du CSV sous un nom temporaire puis RNFR/RNTO. Un index ne
+        décrit qu'une version du CSV : pas de contrôle d'écriture, le dernier envoi
+        l'emporte et un index périmé est ignoré à la lecture. Retourne True si envoyé.
+        """
+        name = sidecar_name(key[1])
+        tmp_name = f"{name}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            data = sidecar.encode()
+            _cwd(self.ftp, key[0])
+            self.ftp.storbinary(f'STOR {tmp_name}', io.BytesIO(data))
+            self._swap_in(tmp_name, name, data)
+        except ftplib.all_errors as e:
+            notify('warning', f"Index serveur de {display_path(*key)} non mis à jour : {e}")
+            return False
+        self.stor_count += 1
+        return True
+
+    @traced
+    def publish_sidecar(self):
+        """
+        Publie l'index serveur de chaque CSV téléchargé pendant l'opération dont le
+        contenu est vérifié (voir _settled). Les CSV écrits ont déjà le leur, envoyé
+        après chaque écriture. Retourne le nombre d'index envoyés.
+        """
+        if self.ftp is None: return 0
+        published = 0
+        for key in sorted(self._downloaded):
+            entry = self._loaded.get(key)
+            if entry is None or entry['stamp'] is None or entry['buffer'] is None or not entry['verified']: continue
+            published += self._upload_sidecar(key, SidecarIndex.from_buffer(entry['stamp'], entry['buffer']))
+        self._downloaded.clear()
+        return published
+
+# --- PRÉCHARGEMENT EN ARRIÈRE-PLAN ---
+
+class FeedWarmer:
+    """
+    Préchargement des CSV d'une session : dès que le mot de passe est connu, un thread
+    ouvre les connexions du pool, télécharge et indexe tous les fichiers, puis les
+    revalide toutes les `interval` secondes (MDTM/SIZE, nouveau téléchargement
+    seulement s'ils ont changé). L'opération lancée ensuite trouve l'index à jour et
+    ne fait que revalider. pause()/resume() encadrent cette opération, qui dispose
+    alors seule des connexions du pool ; l'index est celui du processus. Arrêt après `idle_stop` secondes sans touch(), sur
+    stop() ou si le serveur refuse les identifiants.
+    """
+    def __init__(self, pool, index, files=None, interval=WARMUP_INTERVAL, idle_stop=WARMUP_IDLE_STOP):
+        self.pool, self.index = pool, index
+        self.files = files if files is not None else [key for keys in SITE_FILES.values() for key in keys]
+        self.interval, self.idle_stop = interval, idle_stop
+        self.refreshed_at = None
+        self.refresh_count = 0
+        self.retr_count = 0
+        self.error = None
+        self.rejected = False
+        self._lock = threading.Lock()  # tenu pendant un rafraîchissement ou une opération de l'utilisateur
+        self._stop = threading.Event()
+        self._last_touch = time.monotonic()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Lance le thread s'il ne tourne pas déjà (sauf identifiants refusés)."""
+        if not self.running and not self.rejected:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def touch(self):
+        self._last_touch = time.monotonic()
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        """Attend la fin d'un rafraîchissement en cours et suspend les suivants jusqu'à resume()."""
+        self._lock.acquire()
+
+    def resume(self):
+        self._lock.release()
+
+    def refresh(self):
+        """Une revalidation de tous les fichiers ; retourne l'instantané (compteurs, erreurs par fichier)."""
+        with self._lock, self.pool.connection() as ftp:
+            snapshot = FeedSnapshot(ftp, self.index, self.pool)
+            snapshot.prefetch(self.files)
+        self.refreshed_at = time.time()
+        self.refresh_count += 1
+        self.retr_count += snapshot.retr_count
+        return snapshot
+
+    def _run(self):
+        while not self._stop.is_set() and time.monotonic() - self._last_touch < self.idle_stop:
+            try:
+                self.error = next(iter(self.refresh().errors.values()), None)
+            except ftplib.error_perm as e:
+                self.error, self.rejected = e, True  # identifiants refusés : inutile d'insister
+                return
+            except Exception as e:
+                self.error = e
+            self._stop.wait(self.interval)
+
+# --- FONCTIONS DE RECHERCHE ---
+
+@traced
+def check_id_for_site(snapshot, agency_id, site):
+    """
+    Cherche l'ID dans les CSV du site (en mémoire, ou en flux jusqu'à la ligne de l'agence).
+    Retourne : Liste de tuples (chemin_fichier, mode_contact)
+    """
+    files_to_check = SITE_FILES.get(site)
+    if not files_to_check: return []
+    
+    found_results = []
+    
+    for path, filename in files_to_check:
+        try:
+            match = snapshot.probe(path, filename, agency_id)
+            if match:
+                found_results.append((display_path(path, filename), match[1]))
+        except Exception: pass
+            
+    return found_results
+
+def coherence_status(results):
+    """'absent', 'cohérent', 'global seul' ou 'scindé seul' d'après le résultat de check_id_for_site."""
+    has_global = any(path in GLOBAL_PATHS for path, _ in results)
+    has_split = any(path not in GLOBAL_PATHS for path, _ in results)
+    if has_global and has_split: return 'cohérent'
+    if has_global: return 'global seul'
+    return 'scindé seul' if has_split else 'absent'
+
+def check_coherence(results, site_name):
+    """Affiche des alertes si la config FTP est incohérente"""
+    status = coherence_status(results)
+    if status == 'cohérent':
+        notify('caption', f"✅ Configuration {site_name} cohérente (Présent Global + Split).")
+    elif status == 'global seul':
+        notify('error', f"⚠️ Configuration {site_name} INCOMPLÈTE : Présent dans Global mais manquant dans les fichiers scindés.")
+    elif status == 'scindé seul':
+        notify('error', f"⚠️ Configuration {site_name} INCOMPLÈTE : Présent dans un fichier scindé mais manquant dans Global.")
+
+# --- RÉPARTITION SUR LES FICHIERS SCINDÉS ---
+# Chaque règle reçoit l'ID et la charge des fichiers candidats [{'filename', 'lines', 'bytes'}]
+# (dans l'ordre des fichiers) et retourne le nom du fichier qui recevra l'agence.
+
+def _fewest_lines(agency_id, loads):
+    return min(loads, key=lambda load: load['lines'])['filename']
+
+def _fewest_bytes(agency_id, loads):
+    return min(loads, key=lambda load: load['bytes'])['filename']
+
+def _round_robin(agency_id, loads):
+    # Rang déduit du nombre total d'agences : pas d'état local, même résultat pour tous les opérateurs
+    return loads[sum(load['lines'] for load in loads) % len(loads)]['filename']
+
+def _hashed(agency_id, loads):
+    return loads[zlib.crc32(str(agency_id).encode('utf-8')) % len(loads)]['filename']
+
+SPLIT_POLICIES = {
+    'Moins de lignes': _fewest_lines,
+    "Moins d'octets": _fewest_bytes,
+    'Tourniquet': _round_robin,
+    "Hachage de l'ID": _hashed,
+}
+DEFAULT_SPLIT_POLICY = 'Moins de lignes'
+
+def choose_split_file(agency_id, loads, policy=DEFAULT_SPLIT_POLICY):
+    return SPLIT_POLICIES.get(policy, _fewest_lines)(agency_id, loads)
+
+# --- FONCTIONS D'ACTION (CRUD) ---
+
+def build_record(agency_id, site, contact_mode):
+    # Hash codé en dur comme demandé
+    return f"{agency_id},{SITE_LOGINS[site]},{AGENCY_HASH},agency,{contact_mode}"
+
+@traced
+def ajouter_client(snapshot, agency_id, site, contact_mode, add_to_global=True, add_to_split=True, split_policy=DEFAULT_SPLIT_POLICY):
+    """Ajoute l'agence au fichier Global et à un fichier scindé du site. Retourne les fichiers mis à jour."""
+    updated = []
+    if site not in SITES:
+        notify('error', "Site non valide."); return updated
+    (path_global, global_file), split_files = SITE_FILES[site][0], SITE_FILES[site][1:]
+    prefix = SITES[site]['split_prefix']
+
+    agency_id_str = str(agency_id)
+    new_line_record = build_record(agency_id_str, site, contact_mode)
+
+    @traced
+    def append_content_robust(ftp_path, ftp_filename, new_record):
+        snapshot.append(ftp_path, ftp_filename, [new_record])
+        updated.append(display_path(ftp_path, ftp_filename))
+        notify('info', f"Fichier mis à jour : {ftp_path}/{ftp_filename}")
+
+    # 1. Ajout Global
+    if add_to_global:
+        notify('write', f"Ajout au fichier Global ({global_file})...")
+        append_content_robust(path_global, global_file, new_line_record)
+    else:
+        notify('info', f"Le client est déjà présent dans le fichier Global ({global_file}). Ajout ignoré.")
+
+    # 2. Ajout Split (Load Balancing)
+    if add_to_split:
+        notify('write', f"Analyse des fichiers scindés ({prefix}...) pour le site '{site}'...")
+        loads = []
+        already_exists_in_split = False
+        found_in_file = ""
+        
+        # Scan préventif anti-doublon par l'index (téléchargement seulement si un fichier a changé)
+        # La charge vient de l'index (lignes) et de l'empreinte SIZE (octets)
+        for path_split, filename in split_files:
+            buffer = snapshot.buffer(path_split, filename)
+            if buffer is not None:
+                if snapshot.locate(path_split, filename, agency_id_str):
+                    already_exists_in_split = True
+                    found_in_file = filename
+                    break
+                loads.append({'filename': filename, 'lines': buffer.line_count, 'bytes': snapshot.size(path_split, filename)})
+            else: loads.append({'filename': filename, 'lines': 0, 'bytes': 0})
+
+        if already_exists_in_split:
+            notify('warning', f"⚠️ Action annulée pour les fichiers scindés : L'ID {agency_id} a été trouvé dans **{found_in_file}**.")
+        elif loads:
+            chosen = next(load for load in loads if load['filename'] == choose_split_file(agency_id_str, loads, split_policy))
+            notify('info', f"Fichier scindé retenu ({split_policy}) : {chosen['filename']} ({chosen['lines']} lignes, {chosen['bytes']} octets). Mise à jour...")
+            append_content_robust(SITES[site]['split_path'], chosen['filename'], new_line_record)
+        else: notify('error', "Impossible de trouver les fichiers scindés sur le serveur.")
+    else: notify('info', "La logique a déterminé que l'ID est déjà présent dans un fichier scindé.")
+    return updated
+
+@traced
+def supprimer_client(snapshot, agency_id, site):
+    """Retire l'agence de tous les fichiers du site. Retourne True si elle y figurait."""
+    files_to_check = SITE_FILES.get(site)
+    if not files_to_check: notify('error', f"Site '{site}' non valide pour la suppression."); return False
+
+    agency_id_str, found = str(agency_id), False
+    for path, filename in files_to_check:
+        try:
+            if not snapshot.locate(path, filename, agency_id_str): continue
+            if snapshot.is_loaded(path, filename):
+                snapshot.rewrite(path, filename, lambda current: current.without(agency_id_str)[0])
+            elif not snapshot.stream_rewrite(path, filename, _line_without(agency_id_str), lambda sidecar: sidecar.without(agency_id_str)):
+                continue  # retirée entre-temps par un autre opérateur : plus rien à supprimer
+            found = True
+            notify('info', f"ID {agency_id_str} supprimé dans {path}/{filename}")
+        except WriteConflict as e: notify('error', str(e))
+        except Exception: pass
+    if not found: notify('warning', f"L'ID d'agence {agency_id_str} n'a été trouvé dans aucun fichier du site '{site}'.")
+    return found
+
+@traced
+def modifier_client(snapshot, agency_id, site, new_contact_mode):
+    """Change le mode de contact de l'agence dans les fichiers du site. Retourne True si elle a été trouvée."""
+    files_to_check = SITE_FILES.get(site)
+    if not files_to_check: notify('error', f"Site '{site}' non valide pour la modification."); return False
+    agency_id_str, found_and_modified = str(agency_id), False
+    for path, filename in files_to_check:
+        try:
+            if not snapshot.locate(path, filename, agency_id_str): continue
+            if not snapshot.is_loaded(path, filename):
+                file_was_modified = snapshot.stream_rewrite(path, filename, _line_with_contact_mode(agency_id_str, new_contact_mode),
+                                                            lambda sidecar: sidecar.with_contact_mode(agency_id_str, new_contact_mode)) > 0
+                found_and_modified = found_and_modified or file_was_modified
+                if file_was_modified: notify('info', f"ID {agency_id_str} modifié dans {path}/{filename}")
+                continue
+            _, file_was_modified = snapshot.buffer(path, filename).with_contact_mode(agency_id_str, new_contact_mode)
+            if file_was_modified:
+                found_and_modified = True
+                snapshot.rewrite(path, filename, lambda current: current.with_contact_mode(agency_id_str, new_contact_mode)[0])
+                notify('info', f"ID {agency_id_str} modifié dans {path}/{filename}")
+        except WriteConflict as e: notify('error', str(e))
+        except Exception: pass
+    if not found_and_modified: notify('warning', f"L'ID d'agence {agency_id_str} n'a pas été trouvé pour modification dans les fichiers du site '{site}'.")
+    return found_and_modified
+
+@traced
+def verifier_parametrage_ftp(snapshot, agency_id, site_choice):
+    """
+    Vérification standard sur le FTP. Retourne {site: [(chemin_fichier, mode_contact)]}.
+    """
+    notify('info', f"Recherche de l'ID d'agence '{agency_id}' sur le FTP...")
+    snapshot.prefetch(snapshot.use_sidecar([key for files in SITE_FILES.values() for key in files]), agency_id)
+    
+    results_by_site = {site: check_id_for_site(snapshot, agency_id, site) for site in SITES}
+    all_results = [result for results in results_by_site.values() for result in results]
+    
+    if all_results:
+        notify('success', f"L'ID d'agence '{agency_id}' est présent :")
+        for file_path, mode in all_results:
+            mode_text = "Email Agence (0)" if mode == '0' else "Email Négociateur (1)" if mode == '1' else f"Valeur inconnue ({mode})"
+            notify('write', f"- Dans **{file_path}** avec le mode : **{mode_text}**")
+        
+        # Vérification de cohérence
+        for site in sites_for_choice(site_choice):
+            check_coherence(results_by_site[site], SITE_DISPLAY_NAMES[site])
+    else:
+        notify('info', f"L'ID d'agence '{agency_id}' n'a été trouvé dans aucun fichier CSV.")
+    return results_by_site
+
+# --- VÉRIFICATION EN MASSE ---
+
+def read_id_list(text='', uploaded_file=None):
+    """
+    ID d'agence collés (séparés par des retours à la ligne, espaces, virgules ou
+    points-virgules) et/ou lus dans un CSV/XLSX (colonne agency_id, sinon la première).
+    Retourne la liste sans doublons, dans l'ordre. Lève ValueError si le fichier est illisible.
+    """
+    values = re.split(r'[\s,;]+', text or '')
+    if uploaded_file is not None:
+        if uploaded_file.name.lower().endswith(('.xlsx', '.xls')):
+            import pandas as pd
+            table = pd.read_excel(uploaded_file, dtype=str, header=None).fillna('').values.tolist()
+        else:
+            content = uploaded_file.read()
+            if isinstance(content, bytes): content = content.decode('utf-8-sig', errors='replace')
+            table = [re.split(r'[;,\t]', line) for line in content.splitlines() if line.strip()]
+        if not table: raise ValueError("Fichier vide")
+        header = [str(cell).strip().lower() for cell in table[0]]
+        column = header.index('agency_id') if 'agency_id' in header else 0
+        if not header[column].isdigit(): table = table[1:]  # ligne d'en-tête
+        values += [str(row[column]) if column < len(row) else '' for row in table]
+    ids = []
+    for value in values:
+        value = value.strip()
+        if value.endswith('.0'): value = value[:-2]
+        if value: ids.append(value)
+    return list(dict.fromkeys(ids))
+
+@traced
+def verifier_en_masse(snapshot, agency_ids, sites):
+    """
+    Présence d'une liste d'ID dans tous les CSV des sites, avec une seule lecture de
+    chaque fichier et une jointure vectorisée des ID sur les lignes (feed_frame).
+    Retourne un DataFrame d'une ligne par (ID, site) dans l'ordre de la liste :
+    agency_id, site, une colonne par fichier (mode de contact, vide si absent) et
+    le statut de coherence_status.
+    """
+    import numpy as np
+    import pandas as pd
+    snapshot.prefetch([key for site in sites for key in SITE_FILES[site]])
+    files = {(site, key[1]): display_path(*key) for site in sites for key in SITE_FILES[site]}
+    rows = pd.concat([feed_frame(snapshot, site).assign(site=site) for site in sites], ignore_index=True)
+    rows['agency_id'] = rows['agency_id'].astype(str)  # ID tels qu'écrits, comme la recherche par octets
+    rows = rows[rows['agency_id'].isin(agency_ids)].drop_duplicates(['site', 'fichier', 'agency_id'])
+    rows['colonne'] = [files[key] for key in zip(rows['site'], rows['fichier'])]
+    rows['scindé'] = ~rows['global']
+    grid = pd.MultiIndex.from_product([list(agency_ids), list(sites)], names=['agency_id', 'site'])
+    modes = rows.pivot(index=['agency_id', 'site'], columns='colonne', values='contact_mode').reindex(index=grid, columns=list(files.values()))
+    presence = rows.groupby(['agency_id', 'site'])[['global', 'scindé']].any().reindex(grid, fill_value=False)
+    has_global, has_split = presence['global'].to_numpy(dtype=bool), presence['scindé'].to_numpy(dtype=bool)
+    report = modes.fillna('').reset_index().rename_axis(columns=None)
+    report['site'] = report['site'].map(SITE_DISPLAY_NAMES)
+    report['statut'] = np.select([has_global & has_split, has_global, has_split], ['cohérent', 'global seul', 'scindé seul'], 'absent')
+    return report
+
+# --- TRAITEMENT PAR LOT ---
+
+BATCH_SITES = {
+    **{code: [code] for code in SITES},
+    **{name.lower(): [code] for code, name in SITE_DISPLAY_NAMES.items()},
+    ALL_SITES_LABEL.lower(): list(SITES), 'les deux': list(SITES), 'deux': list(SITES), 'tous': list(SITES),
+}
+BATCH_ACTIONS = {
+    'ajouter': 'Ajouter', 'ajout': 'Ajouter',
+    'supprimer': 'Supprimer', 'suppression': 'Supprimer',
+    'modifier': 'Modifier', 'modification': 'Modifier', 'modifier le mode de contact': 'Modifier',
+}
+
+class EditableFeed:
+    """
+    CSV modifiable en place (ajout, suppression, changement de mode) sur ses colonnes
+    (FeedColumns), pour n'envoyer le fichier qu'une fois à la fin.
+    """
+    def __init__(self, feed):
+        self.columns = FeedColumns.parse(feed)
+        self.dirty = False
+        self.appended = []     # lignes ajoutées en fin de fichier
+        self.rewrite = False   # True si des lignes existantes ont changé : envoi complet nécessaire
+        self.ops = []          # journal des modifications, rejoué en cas de conflit d'écriture
+
+    @property
+    def count(self):
+        return self.columns.count
+
+    @property
+    def nbytes(self):
+        return self.columns.nbytes
+
+    def __contains__(self, agency_id):
+        return bool(self.columns.rows(agency_id))
+
+    def _changed(self, rows):
+        self.dirty = self.dirty or bool(rows)
+        self.rewrite = self.rewrite or bool(rows)
+        return rows
+
+    def append(self, record):
+        self.ops.append(('append', record))
+        self.columns.append(record)
+        self.appended.append(record)
+        self.dirty = True
+
+    def remove(self, agency_id):
+        self.ops.append(('remove', agency_id))
+        return bool(self._changed(self.columns.drop(self.columns.rows(agency_id))))
+
+    def set_contact_mode(self, agency_id, contact_mode):
+        self.ops.append(('set_contact_mode', agency_id, contact_mode))
+        return bool(self._changed(self.columns.set_mode(self.columns.rows(agency_id), contact_mode)))
+
+    def set_contact_modes(self, agency_ids, contact_mode):
+        """set_contact_mode de plusieurs agences en une opération vectorisée. Retourne le nombre de lignes modifiées."""
+        self.ops.append(('set_contact_modes', agency_ids, contact_mode))
+        return self._changed(self.columns.set_mode(self.columns.mask(agency_ids), contact_mode))
+
+    def dedupe(self, agency_id):
+        """Ne garde que la première ligne de l'agence."""
+        self.ops.append(('dedupe', agency_id))
+        return bool(self._changed(self.columns.drop(self.columns.rows(agency_id)[1:])))
+
+    def lines(self):
+        return self.columns.lines()
+
+    def replay(self, feed):
+        """Rejoue le journal sur une autre version du fichier (les ajouts déjà présents sont ignorés). Retourne un FeedBuffer."""
+        fresh = EditableFeed(feed)
+        for op, *args in self.ops:
+            if op == 'append' and args[0].split(',', 1)[0] in fresh: continue
+            getattr(fresh, op)(*args)
+        return FeedBuffer(fresh.columns.to_bytes())
+
+@traced
+def flush_feeds(snapshot, feeds):
+    """
+    Envoie chaque EditableFeed modifié une seule fois : APPE pour les fichiers qui n'ont
+    reçu que des ajouts d'abord, envoi complet des autres ensuite, pour qu'une interruption
+    laisse au pire un doublon plutôt qu'une agence absente. Retourne {clé: exception}.
+    """
+    failed = {}
+    for rewrite in (False, True):
+        for key, edited in feeds.items():
+            if not edited.dirty or edited.rewrite != rewrite: continue
+            try:
+                if rewrite: snapshot.rewrite(*key, edited.replay)
+                else: snapshot.append(*key, edited.appended)
+            except (*ftplib.all_errors, WriteConflict) as e:
+                failed[key] = e
+    return failed
+
+def read_batch_file(uploaded_file, default_site, default_contact_mode):
+    """
+    Lit un CSV/XLSX de colonnes agency_id, action et, optionnellement, site et contact_mode.
+    Retourne une liste de dicts {agency_id, sites, action, contact_mode}. Lève ValueError si le format est invalide.
+    """
+    import pandas as pd
+    if uploaded_file.name.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        df = pd.read_csv(uploaded_file, dtype=str, sep=None, engine='python')
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    missing = {'agency_id', 'action'} - set(df.columns)
+    if missing:
+        raise ValueError(f"Colonne(s) manquante(s) : {', '.join(sorted(missing))}")
+    df = df.fillna('')
+    rows = []
+    for record in df.to_dict('records'):
+        agency_id = record['agency_id'].strip()
+        if agency_id.endswith('.0'): agency_id = agency_id[:-2]
+        site = record.get('site', '').strip().lower() or default_site
+        contact_mode = record.get('contact_mode', '').strip() or str(default_contact_mode)
+        if contact_mode.endswith('.0'): contact_mode = contact_mode[:-2]
+        rows.append({
+            'agency_id': agency_id,
+            'sites': BATCH_SITES.get(site),
+            'action': BATCH_ACTIONS.get(record['action'].strip().lower()),
+            'contact_mode': contact_mode,
+        })
+    return rows
+
+@traced
+def appliquer_lot(snapshot, rows, split_policy=DEFAULT_SPLIT_POLICY, by_row=False):
+    """
+    Applique toutes les lignes du lot en mémoire puis envoie chaque fichier modifié
+    une seule fois (APPE des nouvelles lignes si le fichier n'a reçu que des ajouts). Les nouveaux ID sont répartis sur les fichiers scindés selon la
+    même règle que ajouter_client (split_policy, ou celle de la ligne), évaluée au moment de chaque ajout.
+    Retourne une ligne de résultat par (agence, site) ; by_row=True : une liste de résultats par ligne du lot.
+    """
+    feeds = {}
+    def feed(key):
+        if key not in feeds: feeds[key] = EditableFeed(snapshot.buffer(*key))
+        return feeds[key]
+
+    grouped = []
+    for row in rows:
+        results = []
+        grouped.append(results)
+        agency_id, action, contact_mode = row['agency_id'], row['action'], row['contact_mode']
+        if not agency_id or not action or not row['sites'] or contact_mode not in ('0', '1'):
+            results.append({'agency_id': agency_id, 'site': '', 'action': action or '', 'résultat': "Ligne invalide (ID, site, action ou mode de contact)", 'fichiers': []})
+            continue
+        for site in row['sites']:
+            global_key, split_keys = SITE_FILES[site][0], SITE_FILES[site][1:]
+            touched, status = [], ''
+            if action == 'Ajouter':
+                record = build_record(agency_id, site, contact_mode)
+                if agency_id not in feed(global_key):
+                    feed(global_key).append(record); touched.append(global_key)
+                if not any(agency_id in feed(key) for key in split_keys):
+                    loads = [{'filename': key[1], 'lines': feed(key).count, 'bytes': feed(key).nbytes} for key in split_keys]
+                    chosen = next(key for key in split_keys if key[1] == choose_split_file(agency_id, loads, row.get('split_policy', split_policy)))
+                    feed(chosen).append(record); touched.append(chosen)
+                status = "Ajouté" if touched else "Déjà configuré"
+            elif action == 'Supprimer':
+                touched = [key for key in SITE_FILES[site] if feed(key).remove(agency_id)]
+                status = "Supprimé" if touched else "Introuvable"
+            elif action == 'Modifier':
+                touched = [key for key in SITE_FILES[site] if feed(key).set_contact_mode(agency_id, contact_mode)]
+                status = "Modifié" if touched else "Introuvable"
+            results.append({'agency_id': agency_id, 'site': SITE_DISPLAY_NAMES[site], 'action': action, 'résultat': status, 'fichiers': touched})
+
+    failed = flush_feeds(snapshot, feeds)
+    for result in (result for results in grouped for result in results):
+        errors = [f"{path}/{filename} : {failed[(path, filename)]}" for path, filename in result['fichiers'] if (path, filename) in failed]
+        if errors: result['résultat'] = "Échec d'envoi (" + "; ".join(errors) + ")"
+        result['fichiers'] = ", ".join(f"{path}/{filename}".replace("//", "/") for path, filename in result['fichiers'])
+    return grouped if by_row else [result for results in grouped for result in results]
+
+# --- ÉCRITURES GROUPÉES ENTRE SESSIONS ---
+
+class WriteCoordinator:
+    """
+    File d'écriture partagée par toutes les sessions du processus (cache_resource
+    côté Streamlit). Les demandes d'ajout, de suppression et de modification reçues
+    pendant `window` secondes sont appliquées ensemble par appliquer_lot : une
+    lecture et un seul envoi par fichier touché, au lieu d'un cycle complet par
+    opérateur. Les fichiers touchés sont tenus en mémoire : suppressions et
+    modifications ne passent pas par la réécriture en flux (stream_rewrite). La première session arrivée attend la fenêtre puis écrit pour
+    toutes ; chaque appelant reçoit ses propres lignes de résultat. index : celui du
+    processus, partagé avec les sessions, qui voient ainsi les fichiers écrits.
+    """
+    def __init__(self, index, window=GROUP_COMMIT_WINDOW):
+        self.index = index
+        self.window = window
+        self._lock = threading.Lock()        # file des demandes
+        self._flush_lock = threading.Lock()  # un seul envoi à la fois
+        self._pending = []                   # [(lignes, split_policy, Future)]
+        self.flush_count = 0
+        self.request_count = 0
+
+    TRANSFER_COUNTERS = ('retr_count', 'stor_count', 'reused_count', 'conflict_count', 'sidecar_count', 'partial_count')
+
+    def submit(self, pool, rows, split_policy=DEFAULT_SPLIT_POLICY, snapshot=None):
+        """
+        Lignes au format de appliquer_lot ; bloque jusqu'à l'envoi et retourne une liste
+        de résultats par ligne. snapshot : FeedSnapshot de l'appelant, crédité des
+        transferts de l'envoi groupé (communs à toutes les demandes de l'envoi).
+        """
+        future = Future()
+        with self._lock:
+            leader = not self._pending
+            self._pending.append((rows, split_policy, future))
+        if leader:
+            try:
+                time.sleep(self.window)
+                self._flush(pool)
+            except BaseException as e:
+                # Meneur interrompu (arrêt ou rerun de sa session) avant de prendre la file : elle échoue avec lui
+                with self._lock:
+                    queued = any(item[2] is future for item in self._pending)
+                    pending, self._pending = (self._pending, []) if queued else ([], self._pending)
+                self._fail(pending, e)
+                raise
+        results, transfers = future.result()
+        if snapshot is not None:
+            for name, count in transfers.items(): setattr(snapshot, name, getattr(snapshot, name) + count)
+        return results
+
+    @staticmethod
+    def _fail(pending, error):
+        """Chaque demande encore en attente reçoit l'erreur ; une interruption (BaseException) devient RuntimeError chez les autres sessions."""
+        if not isinstance(error, Exception): error = RuntimeError(f"Envoi groupé interrompu ({type(error).__name__}).")
+        for _, _, future in pending:
+            if not future.done(): future.set_exception(error)
+
+    @traced
+    def _flush(self, pool):
+        with self._flush_lock:
+            with self._lock: pending, self._pending = self._pending, []
+            rows = [{**row, 'split_policy': row.get('split_policy', split_policy)} for rows, split_policy, _ in pending for row in rows]
+            try:
+                with pool.connection() as ftp:
+                    snapshot = FeedSnapshot(ftp, self.index, pool)
+                    sites = {site for row in rows for site in row['sites'] or [] if site in SITE_FILES}
+                    snapshot.prefetch([key for site in SITES if site in sites for key in SITE_FILES[site]])
+                    grouped = appliquer_lot(snapshot, rows, by_row=True)
+                    snapshot.publish_sidecar()
+            except BaseException as e:
+                self._fail(pending, e)
+                if not isinstance(e, Exception): raise
+                return
+            self.flush_count += 1
+            self.request_count += len(pending)
+            transfers = {name: getattr(snapshot, name) for name in self.TRANSFER_COUNTERS}
+            start = 0
+            for requested, _, future in pending:
+                future.set_result((grouped[start:start + len(requested)], transfers))
+                start += len(requested)
+
+# --- RÉÉQUILIBRAGE DES FICHIERS SCINDÉS ---
+
+def read_weights_file(uploaded_file):
+    """
+    Lit un CSV/XLSX local (agency_id, volume) donnant le nombre d'annonces par agence.
+    Retourne {agency_id: poids}. Les agences absentes du fichier pèsent 1.
+    """
+    import pandas as pd
+    if uploaded_file.name.lower().endswith(('.xlsx', '.xls')):
+        df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        df = pd.read_csv(uploaded_file, dtype=str, sep=None, engine='python')
+    if len(df.columns) < 2:
+        raise ValueError("Deux colonnes attendues : agency_id, volume")
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    id_col = 'agency_id' if 'agency_id' in df.columns else df.columns[0]
+    volume_col = 'volume' if 'volume' in df.columns else [c for c in df.columns if c != id_col][0]
+    ids = df[id_col].fillna('').str.strip().str.replace(r'\.0$', '', regex=True)
+    volumes = pd.to_numeric(df[volume_col], errors='coerce').fillna(0).clip(lower=0)
+    return dict(zip(ids, volumes))
+
+@traced
+def find_orphan_split_files(snapshot, site):
+    """
+    Fichiers scindés présents sur le serveur (<split_prefix><n>.csv) mais hors de la
+    topologie configurée, par exemple après une réduction de "shards" dans sites.toml.
+    """
+    config = SITES[site]
+    _cwd(snapshot.ftp, config['split_path'])
+    pattern = re.compile(rf"^{re.escape(config['split_prefix'])}(\d+)\.csv$")
+    configured = {filename for _, filename in SITE_FILES[site][1:]}
+    return sorted(name for name in (n.rsplit('/', 1)[-1] for n in snapshot.ftp.nlst())
+                  if pattern.match(name) and name not in configured)
+
+@traced
+def planifier_reequilibrage(snapshot, site, weights=None, orphan_files=()):
+    """
+    Calcule un plan de déplacements minimal pour égaliser la charge des fichiers
+    scindés du site (nombre de lignes, ou volume d'annonces si weights est fourni).
+    Les agences des orphan_files (fichiers hors topologie) sont d'abord versées une à
+    une dans le fichier configuré le moins chargé. Ensuite, à chaque étape, l'agence du
+    fichier le plus chargé dont le poids réduit le plus l'écart avec le fichier le moins
+    chargé y est déplacée ; on s'arrête quand plus aucun déplacement ne réduit l'écart.
+    Le fichier Global n'est pas concerné.
+    Retourne (déplacements, charge avant, charge après).
+    """
+    weights = weights or {}
+    split_path = SITES[site]['split_path']
+    members, columns, rows_by_id = {}, {}, {}
+    for path, filename in SITE_FILES[site][1:] + [(split_path, name) for name in orphan_files]:
+        members[filename], columns[filename] = {}, FeedColumns.parse(snapshot.buffer(path, filename))
+        frame = columns[filename].frame()
+        for row, agency_id in zip(frame['rang'].tolist(), frame['agency_id'].astype(str).tolist()):
+            members[filename][agency_id] = weights.get(agency_id, 1) if weights else 1
+            rows_by_id.setdefault((filename, agency_id), row)
+    line = lambda filename, agency_id: columns[filename].line(rows_by_id[(filename, agency_id)])  # décodée pour les seules agences déplacées
+    loads = {filename: sum(agencies.values()) for filename, agencies in members.items()}
+    before = dict(loads)
+    moves = []
+    for orphan in orphan_files:
+        for agency_id, w in list(members[orphan].items()):
+            del members[orphan][agency_id]
+            loads[orphan] -= w
+            configured = [f for f in loads if f not in orphan_files]
+            if any(agency_id in members[f] for f in configured):
+                light = None  # déjà présente dans un fichier configuré : simple retrait du doublon
+            else:
+                light = min(configured, key=loads.get)
+                members[light][agency_id] = w
+                loads[light] += w
+            moves.append({'agency_id': agency_id, 'de': orphan, 'vers': light, 'poids': w, 'ligne': line(orphan, agency_id)})
+        del loads[orphan]
+    while len(loads) > 1:
+        heavy = max(loads, key=loads.get)
+        light = min(loads, key=loads.get)
+        gap = loads[heavy] - loads[light]
+        candidates = [(abs(gap / 2 - w), agency_id) for agency_id, w in members[heavy].items()
+                      if 0 < w < gap and agency_id not in members[light]]
+        if not candidates: break
+        _, agency_id = min(candidates)
+        w = members[heavy].pop(agency_id)
+        members[light][agency_id] = w
+        loads[heavy] -= w
+        loads[light] += w
+        moves.append({'agency_id': agency_id, 'de': heavy, 'vers': light, 'poids': w, 'ligne': line(heavy, agency_id)})
+    return moves, before, {**loads, **{orphan: 0 for orphan in orphan_files}}
+
+@traced
+def appliquer_reequilibrage(snapshot, site, moves):
+    """
+    Applique un plan : les lignes sont déplacées telles quelles (mode de contact inchangé)
+    et chaque fichier modifié est envoyé une seule fois par flush_feeds ('vers' à None :
+    simple retrait). Les déplacements devenus caducs sont ignorés.
+    """
+    split_path = SITES[site]['split_path']
+    split_keys = {filename: (path, filename) for path, filename in SITE_FILES[site][1:]}
+    split_keys.update({move['de']: (split_path, move['de']) for move in moves})
+    feeds = {key: EditableFeed(snapshot.buffer(*key)) for key in split_keys.values()}
+    applied = 0
+    for move in moves:
+        source, target = feeds[split_keys[move['de']]], feeds.get(split_keys.get(move['vers']))
+        if move['agency_id'] not in source or (target is not None and move['agency_id'] in target): continue
+        source.remove(move['agency_id'])
+        if target is not None: target.append(move['ligne'])
+        applied += 1
+    failed = flush_feeds(snapshot, feeds)
+    for key, edited in feeds.items():
+        if key in failed: notify('error', f"Échec de l'envoi de {display_path(*key)} : {failed[key]}")
+        elif edited.dirty: notify('info', f"Fichier mis à jour : {display_path(*key)} ({edited.count} lignes)")
+    if applied < len(moves):
+        notify('warning', f"{len(moves) - applied} déplacement(s) ignoré(s) : les fichiers ont changé depuis le calcul du plan.")
+    return applied
+
+# --- AUDIT DE COHÉRENCE ---
+
+ANOMALY_GLOBAL_ONLY = "Global sans fichier scindé"
+ANOMALY_SPLIT_ONLY = "Scindé sans Global"
+ANOMALY_MULTI_SPLIT = "Plusieurs fichiers scindés"
+ANOMALY_MODE = "Mode de contact différent du Global"
+ANOMALY_DUPLICATE = "Doublon dans un fichier"
+
+def feed_frame(snapshot, site, feeds=None):
+    """
+    Toutes les lignes des CSV du site dans un DataFrame (fichier, global, rang, agency_id,
+    contact_mode), construit depuis les colonnes des fichiers sans texte par ligne ;
+    agency_id est entier sauf pour les ID hors format. feeds : {clé: EditableFeed} déjà lus.
+    """
+    import pandas as pd
+    frames = []
+    for n, key in enumerate(SITE_FILES[site]):
+        columns = feeds[key].columns if feeds else FeedColumns.parse(snapshot.buffer(*key))
+        frames.append(columns.frame().assign(fichier=key[1], **{'global': n == 0}))
+    return pd.concat(frames, ignore_index=True)[['fichier', 'global', 'rang', 'agency_id', 'contact_mode']]
+
+def _anomalies(df):
+    """Anomalies d'un site par opérations ensemblistes vectorisées. Retourne {type: DataFrame}."""
+    glob, split = df[df['global']], df[~df['global']]
+    glob_first = glob.drop_duplicates('agency_id')
+    split_first = split.drop_duplicates(['fichier', 'agency_id'])
+    in_several = split_first[split_first['agency_id'].duplicated(keep=False)]
+    split_files = in_several.groupby('agency_id')['fichier'].agg(list)
+    modes = split_first.merge(glob_first[['agency_id', 'contact_mode']], on='agency_id', suffixes=('', '_global'))
+    return {
+        ANOMALY_DUPLICATE: df[df.duplicated(['fichier', 'agency_id'])].drop_duplicates(['fichier', 'agency_id']),
+        ANOMALY_GLOBAL_ONLY: glob_first[~glob_first['agency_id'].isin(split['agency_id'])],
+        ANOMALY_SPLIT_ONLY: split_first[~split_first['agency_id'].isin(glob['agency_id'])].drop_duplicates('agency_id'),
+        ANOMALY_MULTI_SPLIT: split_files,
+        ANOMALY_MODE: modes[modes['contact_mode'] != modes['contact_mode_global']],
+    }
+
+@traced
+def auditer_site(snapshot, site):
+    """
+    Contrôle de cohérence de toutes les agences du site en un seul passage.
+    Retourne un DataFrame (site, agency_id, anomalie, détail), vide si tout est cohérent.
+    """
+    import pandas as pd
+    found = _anomalies(feed_frame(snapshot, site))
+    multi = found[ANOMALY_MULTI_SPLIT]
+    modes = found[ANOMALY_MODE]
+    report = pd.concat([
+        pd.DataFrame({'agency_id': found[ANOMALY_DUPLICATE]['agency_id'], 'anomalie': ANOMALY_DUPLICATE, 'détail': found[ANOMALY_DUPLICATE]['fichier']}),
+        pd.DataFrame({'agency_id': found[ANOMALY_GLOBAL_ONLY]['agency_id'], 'anomalie': ANOMALY_GLOBAL_ONLY, 'détail': found[ANOMALY_GLOBAL_ONLY]['fichier']}),
+        pd.DataFrame({'agency_id': found[ANOMALY_SPLIT_ONLY]['agency_id'], 'anomalie': ANOMALY_SPLIT_ONLY, 'détail': found[ANOMALY_SPLIT_ONLY]['fichier']}),
+        pd.DataFrame({'agency_id': multi.index, 'anomalie': ANOMALY_MULTI_SPLIT, 'détail': multi.str.join(', ').values}),
+        pd.DataFrame({'agency_id': modes['agency_id'], 'anomalie': ANOMALY_MODE,
+                      'détail': modes['fichier'].astype(str) + ' : ' + modes['contact_mode'].astype(str) + ' (Global : ' + modes['contact_mode_global'].astype(str) + ')'}),
+    ], ignore_index=True)
+    report['agency_id'] = report['agency_id'].astype(str)
+    report.insert(0, 'site', SITE_DISPLAY_NAMES[site])
+    return report
+
+@traced
+def corriger_anomalies(snapshot, site, split_policy=DEFAULT_SPLIT_POLICY):
+    """
+    Corrige toutes les anomalies du site, le fichier Global faisant référence :
+    doublons supprimés, agence gardée dans son premier fichier scindé seulement,
+    mode du Global reporté dans le scindé, agence manquante ajoutée au Global ou
+    au fichier scindé choisi par split_policy. Chaque fichier est envoyé une seule fois.
+    Retourne (nombre de corrections, {clé: exception} des envois échoués).
+    """
+    feeds = {key: EditableFeed(snapshot.buffer(*key)) for key in SITE_FILES[site]}
+    found = _anomalies(feed_frame(snapshot, site, feeds))
+    keys = {filename: (path, filename) for path, filename in SITE_FILES[site]}
+    global_key, split_keys = SITE_FILES[site][0], SITE_FILES[site][1:]
+    line = lambda filename, row: feeds[keys[filename]].columns.line(row)  # texte lu avant toute correction
+    global_only = [(agency_id, line(filename, row)) for agency_id, filename, row in found[ANOMALY_GLOBAL_ONLY][['agency_id', 'fichier', 'rang']].itertuples(index=False)]
+    split_only = [line(filename, row) for filename, row in found[ANOMALY_SPLIT_ONLY][['fichier', 'rang']].itertuples(index=False)]
+    fixes = 0
+    for filename, agency_id in found[ANOMALY_DUPLICATE][['fichier', 'agency_id']].itertuples(index=False):
+        fixes += feeds[keys[filename]].dedupe(agency_id)
+    for agency_id, filenames in found[ANOMALY_MULTI_SPLIT].items():
+        fixes += any([feeds[keys[filename]].remove(agency_id) for filename in filenames[1:]])
+    for mode, agency_ids in found[ANOMALY_MODE].groupby('contact_mode_global')['agency_id']:
+        # Une opération vectorisée par mode cible et par fichier scindé
+        fixes += agency_ids.nunique()
+        for key in split_keys: feeds[key].set_contact_modes(agency_ids.tolist(), mode)
+    for agency_id, record in global_only:
+        loads = [{'filename': key[1], 'lines': feeds[key].count, 'bytes': feeds[key].nbytes} for key in split_keys]
+        feeds[keys[choose_split_file(str(agency_id), loads, split_policy)]].append(record)
+        fixes += 1
+    for record in split_only:
+        feeds[global_key].append(record)
+        fixes += 1
+    return fixes, flush_feeds(snapshot, feeds)
+
+
+# --- MOTEUR ASYNCHRONE ---
+
+class AsyncFeedEngine:
+    """
+    Exécute une opération avec asyncio : tous les fichiers sont chargés en parallèle,
+    puis chaque site travaille sur sa propre connexion du pool (instantané dédié,
+    index partagé), de sorte que les RETR/STOR des deux sites se recouvrent.
+    on_progress(terminés, total, libellé) est appelé dans le thread appelant à
+    chaque fichier puis à chaque site terminé ; thread_setup() est exécutée au début
+    de chaque thread de travail (rattachement au script Streamlit par exemple).
+    Le traitement séquentiel (FeedSnapshot seul) reste le chemin de repli.
+    """
+    def __init__(self, snapshot, on_progress=None, thread_setup=None):
+        self.snapshot = snapshot  # instantané principal : cumule lignes, compteurs et erreurs
+        self.on_progress = on_progress or (lambda done, total, label: None)
+        self.thread_setup = thread_setup
+
+    def _in_thread(self, work):
+        setup = self.thread_setup
+        def run(*args):
+            if setup is not None: setup()
+            return work(*args)
+        return run
+
+    async def _run_all(self, work, items, label):
+        """work(item) pour chaque item, en parallèle : {item: résultat ou exception}."""
+        import asyncio
+        run = self._in_thread(work)
+        async def one(item):
+            try: return item, await asyncio.to_thread(run, item)
+            except Exception as e: return item, e
+        results = {}
+        for done, task in enumerate(asyncio.as_completed([one(item) for item in items]), 1):
+            item, result = await task
+            results[item] = result
+            self.on_progress(done, len(items), label(item))
+        return results
+
+    async def _prefetch(self, files, agency_id):
+        token = _current_function.set('prefetch')  # copié dans chaque tâche, puis dans son thread
+        try: await self._prefetch_files(files, agency_id)
+        finally: _current_function.reset(token)
+
+    async def _prefetch_files(self, files, agency_id):
+        snapshot = self.snapshot
+        todo = snapshot._pending(files)
+        known = {key: snapshot.index.known_stamp(key) for key in todo}
+        def work(key):
+            with snapshot.pool.connection() as ftp:
+                return fetch_feed(ftp, *key, known[key]) if agency_id is None else scan_feed(ftp, *key, known[key], agency_id)
+        for key, result in (await self._run_all(work, todo, lambda key: display_path(*key))).items():
+            if isinstance(result, Exception): snapshot.errors[key] = result
+            elif agency_id is None: snapshot._apply(key, *result)
+            else: snapshot._apply_scan(key, agency_id, *result)
+
+    def _site_snapshot(self, ftp):
+        child = FeedSnapshot(ftp, self.snapshot.index, self.snapshot.pool)
+        child._loaded = dict(self.snapshot._loaded)
+        child._probes = dict(self.snapshot._probes)
+        child.sidecars = dict(self.snapshot.sidecars)
+        child.appe_supported = self.snapshot.appe_supported
+        return child
+
+    def _merge(self, child):
+        snapshot = self.snapshot
+        snapshot._loaded.update(child._loaded)
+        # Fichiers réécrits en flux par le site : ni lecture interrompue ni index serveur encore valables
+        snapshot._probes = {key: probe for key, probe in snapshot._probes.items() if key in child._probes}
+        snapshot.sidecars = {key: sidecar for key, sidecar in snapshot.sidecars.items() if key in child.sidecars}
+        snapshot._downloaded |= child._downloaded
+        snapshot.errors.update(child.errors)
+        snapshot.retr_count += child.retr_count
+        snapshot.stor_count += child.stor_count
+        snapshot.reused_count += child.reused_count
+        snapshot.conflict_count += child.conflict_count
+        snapshot.partial_count += child.partial_count
+        snapshot.appe_supported = snapshot.appe_supported and child.appe_supported
+
+    async def _run_sites(self, sites, operation):
+        children = {}
+        def work(site_code):
+            with self.snapshot.pool.connection() as ftp:
+                children[site_code] = self._site_snapshot(ftp)
+                return operation(children[site_code], site_code)
+        results = await self._run_all(work, sites, lambda site_code: SITE_DISPLAY_NAMES[site_code])
+        for child in children.values(): self._merge(child)
+        for result in results.values():
+            if isinstance(result, Exception): raise result
+        return results
+
+    def prefetch(self, files, agency_id=None):
+        import asyncio
+        asyncio.run(self._prefetch(files, agency_id))
+
+    def run_sites(self, sites, operation):
+        """operation(instantané, site) pour chaque site en parallèle : {site: résultat}."""
+        import asyncio
+        return asyncio.run(self._run_sites(sites, operation))
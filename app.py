@@ -1,247 +1,86 @@
 # app.py
+# Interface Streamlit : client du moteur apimo_core (logique FTP/CSV sans interface).
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import ftplib
-import io
+import threading
+import time
 import traceback
-import pandas as pd # Import conservé pour compatibilité future
+import pandas as pd
+from apimo_core import (
+    ALL_SITES_LABEL, APP_VERSION, DEFAULT_SPLIT_POLICY, FTP_HOST, FTP_USER, GLOBAL_PATHS, MIRROR_DIR,
+    MIRROR_MAX_AGE, PERF_LOG_PATH, SITE_DISPLAY_NAMES, SITE_FILES, SPLIT_POLICIES,
+    AgencyIndex, AsyncFeedEngine, FeedMirror, FeedSnapshot, FeedWarmer, FTPPool, WriteCoordinator,
+    ajouter_client, appliquer_lot, appliquer_reequilibrage, auditer_site, check_id_for_site, corriger_anomalies, display_path,
+    find_orphan_split_files, modifier_client, planifier_reequilibrage, read_batch_file, read_id_list, read_weights_file,
+    set_event_sink, sites_for_choice, start_trace, stop_trace, supprimer_client, traced, verifier_en_masse, verifier_parametrage_ftp,
+)
 
-# --- CONFIGURATION ET NUMÉRO DE VERSION ---
-APP_VERSION = "v1.10.2" # Correction bug variable 'display_name' dans Modifier
-FTP_HOST = "ftp.figarocms.fr"
-FTP_USER = "apimo-auto-fab"
+# --- SESSION STREAMLIT (CONNEXIONS, INDEX, MESSAGES) ---
 
-# --- FONCTIONS TECHNIQUES FTP ---
+def get_ftp_pool(host, user, password):
+    """Pool de la session courante, recréé si les identifiants changent."""
+    pool = st.session_state.get('ftp_pool')
+    if pool is None or (pool.host, pool.user, pool.password) != (host, user, password):
+        if pool is not None: pool.close_all()
+        pool = FTPPool(host, user, password)
+        st.session_state['ftp_pool'] = pool
+    return pool
 
+@traced
 def connect_ftp(host, user, password):
+    """Connexion de l'opération ; le préchargement de fond est suspendu jusqu'à release_ftp."""
+    warmer = st.session_state.get('feed_warmer')
+    if warmer is not None: warmer.pause()
     try:
-        ftp = ftplib.FTP_TLS(host, timeout=60)
-        ftp.sendcmd('USER ' + user)
-        ftp.sendcmd('PASS ' + password)
-        return ftp
+        return get_ftp_pool(host, user, password).acquire()
     except ftplib.all_errors as e:
+        if warmer is not None: warmer.resume()
         st.error(f"La connexion FTP a échoué : {e}")
         return None
 
-def check_id_for_site(ftp, agency_id, site):
-    """
-    Scanne les fichiers CSV sur le FTP pour trouver l'ID.
-    Retourne : Liste de tuples (chemin_fichier, mode_contact)
-    """
-    if site == 'figaro':
-        files_to_check = [("All", 'apimo_1.csv'), ("/", 'apimo_11.csv'), ("/", 'apimo_12.csv'), ("/", 'apimo_13.csv')]
-    elif site == 'proprietes':
-        files_to_check = [("All", 'apimo_3.csv'), ("/", 'apimo_31.csv'), ("/", 'apimo_32.csv'), ("/", 'apimo_33.csv')]
+def release_ftp(ftp, discard=False):
+    """Rend la connexion obtenue par connect_ftp au pool de la session."""
+    pool = st.session_state.get('ftp_pool')
+    if pool is None:
+        FTPPool._close(ftp)
     else:
-        return []
-    
-    agency_id_str = str(agency_id)
-    found_results = []
-    
-    for path, filename in files_to_check:
-        try:
-            ftp.cwd("/")
-            if path != "/": ftp.cwd(path)
-            
-            r = io.BytesIO()
-            ftp.retrbinary(f'RETR {filename}', r.write)
-            r.seek(0)
-            
-            content = r.getvalue().decode('utf-8', errors='ignore')
-            for line in content.splitlines():
-                if line.strip().startswith(agency_id_str + ','):
-                    parts = line.strip().split(',')
-                    contact_mode = parts[-1] if len(parts) >= 5 else '?'
-                    
-                    if path == "/": clean_path = f"/{filename}"
-                    else: clean_path = f"{path}/{filename}"
-                        
-                    found_results.append((clean_path, contact_mode))
-                    break 
-        except Exception: pass
-            
-    return found_results
-
-def check_coherence(results, site_name):
-    """Affiche des alertes si la config FTP est incohérente"""
-    if not results: return
-    has_global = any("All/" in path for path, _ in results)
-    has_split = any("All/" not in path for path, _ in results)
-    
-    if has_global and has_split:
-        st.caption(f"✅ Configuration {site_name} cohérente (Présent Global + Split).")
-    elif has_global and not has_split:
-        st.error(f"⚠️ Configuration {site_name} INCOMPLÈTE : Présent dans Global mais manquant dans les fichiers scindés.")
-    elif not has_global and has_split:
-        st.error(f"⚠️ Configuration {site_name} INCOMPLÈTE : Présent dans un fichier scindé mais manquant dans Global.")
-
-# --- FONCTIONS D'ACTION (CRUD) ---
-
-def ajouter_client(ftp, agency_id, site, contact_mode, add_to_global=True, add_to_split=True):
-    if site == 'figaro':
-        login, global_file, prefix, indices = '694', 'apimo_1.csv', 'apimo_1', ['1', '2', '3']
-    elif site == 'proprietes':
-        login, global_file, prefix, indices = '421', 'apimo_3.csv', 'apimo_3', ['1', '2', '3']
-    else:
-        st.error("Site non valide."); return
+        pool.release(ftp, discard)
+    warmer = st.session_state.get('feed_warmer')
+    if warmer is not None: warmer.resume()
 
-    agency_id_str = str(agency_id)
-    # Hash codé en dur comme demandé
-    new_line_record = f"{agency_id_str},{login},df93c3658a012b239ff59ccee0536f592d0c54b7,agency,{contact_mode}"
-    path_global, path_split = "All", "/"
+def get_feed_warmer(pool):
+    """Préchargement de fond de la session, recréé avec le pool (identifiants changés)."""
+    warmer = st.session_state.get('feed_warmer')
+    if warmer is None or warmer.pool is not pool:
+        if warmer is not None: warmer.stop()
+        warmer = FeedWarmer(pool, get_agency_index())
+        st.session_state['feed_warmer'] = warmer
+    warmer.touch()
+    return warmer.start()
 
-    def append_content_robust(ftp_path, ftp_filename, new_record):
-        ftp.cwd("/")
-        if ftp_path != "/": ftp.cwd(ftp_path)
-        lines = []
-        try:
-            content_in_memory = io.BytesIO()
-            ftp.retrbinary(f'RETR {ftp_filename}', content_in_memory.write)
-            content_decoded = content_in_memory.getvalue().decode('utf-8', errors='ignore')
-            lines = [line for line in content_decoded.splitlines() if line.strip()]
-        except ftplib.error_perm: pass
-        lines.append(new_record)
-        new_content = "\n".join(lines)
-        content_to_upload = io.BytesIO(new_content.encode('utf-8'))
-        ftp.cwd("/")
-        if ftp_path != "/": ftp.cwd(ftp_path)
-        ftp.storbinary(f'STOR {ftp_filename}', content_to_upload)
-        st.info(f"Fichier mis à jour : {ftp_path}/{ftp_filename}")
-
-    # 1. Ajout Global
-    if add_to_global:
-        st.write(f"Ajout au fichier Global ({global_file})...")
-        append_content_robust(path_global, global_file, new_line_record)
-    else:
-        st.info(f"Le client est déjà présent dans le fichier Global ({global_file}). Ajout ignoré.")
-
-    # 2. Ajout Split (Load Balancing)
-    if add_to_split:
-        st.write(f"Analyse des fichiers scindés ({prefix}...) pour le site '{site}'...")
-        ftp.cwd(path_split)
-        nlst = ftp.nlst()
-        line_counts = {}
-        already_exists_in_split = False
-        found_in_file = ""
-        
-        # Scan préventif anti-doublon
-        for i in indices:
-            filename = f"{prefix}{i}.csv"
-            if filename in nlst:
-                content_in_memory = io.BytesIO()
-                ftp.retrbinary(f'RETR {filename}', content_in_memory.write)
-                content_str = content_in_memory.getvalue().decode('utf-8', errors='ignore')
-                lines = [line for line in content_str.splitlines() if line.strip()]
-                for line in lines:
-                    if line.startswith(agency_id_str + ','):
-                        already_exists_in_split = True
-                        found_in_file = filename
-                        break
-                if already_exists_in_split: break
-                line_counts[filename] = len(lines)
-            else: line_counts[filename] = 0
-
-        if already_exists_in_split:
-            st.warning(f"⚠️ Action annulée pour les fichiers scindés : L'ID {agency_id} a été trouvé dans **{found_in_file}**.")
-        elif line_counts:
-            smallest_file = min(line_counts, key=line_counts.get)
-            st.info(f"Le fichier le plus léger est : {smallest_file} ({line_counts[smallest_file]} lignes). Mise à jour...")
-            append_content_robust(path_split, smallest_file, new_line_record)
-        else: st.error("Impossible de trouver les fichiers scindés sur le serveur.")
-    else: st.info("La logique a déterminé que l'ID est déjà présent dans un fichier scindé.")
-
-def supprimer_client(ftp, agency_id, site):
-    if site == 'figaro':
-        files_to_check = [("All", 'apimo_1.csv'), ("/", 'apimo_11.csv'), ("/", 'apimo_12.csv'), ("/", 'apimo_13.csv')]
-    elif site == 'proprietes':
-        files_to_check = [("All", 'apimo_3.csv'), ("/", 'apimo_31.csv'), ("/", 'apimo_32.csv'), ("/", 'apimo_33.csv')]
-    else: st.error(f"Site '{site}' non valide pour la suppression."); return
-
-    agency_id_str, found = str(agency_id), False
-    for path, filename in files_to_check:
-        try:
-            ftp.cwd("/")
-            if path != "/": ftp.cwd(path)
-            r = io.BytesIO()
-            ftp.retrbinary(f'RETR {filename}', r.write)
-            r.seek(0)
-            if r.getbuffer().nbytes == 0: continue
-            lines = [line.strip() for line in r.getvalue().decode('utf-8', errors='ignore').splitlines() if line.strip()]
-            initial_rows = len(lines)
-            lines_filtered = [line for line in lines if not line.startswith(agency_id_str + ',')]
-            if len(lines_filtered) < initial_rows:
-                found = True
-                new_content = "\n".join(lines_filtered)
-                content_io = io.BytesIO(new_content.encode('utf-8'))
-                ftp.cwd("/")
-                if path != "/": ftp.cwd(path)
-                ftp.storbinary(f'STOR {filename}', content_io)
-                st.info(f"ID {agency_id_str} supprimé dans {path}/{filename}")
-        except Exception: pass
-    if not found: st.warning(f"L'ID d'agence {agency_id_str} n'a été trouvé dans aucun fichier du site '{site}'.")
-
-def modifier_client(ftp, agency_id, site, new_contact_mode):
-    if site == 'figaro':
-        files_to_check = [("All", 'apimo_1.csv'), ("/", 'apimo_11.csv'), ("/", 'apimo_12.csv'), ("/", 'apimo_13.csv')]
-    elif site == 'proprietes':
-        files_to_check = [("All", 'apimo_3.csv'), ("/", 'apimo_31.csv'), ("/", 'apimo_32.csv'), ("/", 'apimo_33.csv')]
-    else: st.error(f"Site '{site}' non valide pour la modification."); return
-    agency_id_str, found_and_modified = str(agency_id), False
-    for path, filename in files_to_check:
-        try:
-            ftp.cwd("/")
-            if path != "/": ftp.cwd(path)
-            r = io.BytesIO()
-            ftp.retrbinary(f'RETR {filename}', r.write)
-            r.seek(0)
-            if r.getbuffer().nbytes == 0: continue
-            lines = [line.strip() for line in r.getvalue().decode('utf-8', errors='ignore').splitlines() if line.strip()]
-            new_lines = []
-            file_was_modified = False
-            for line in lines:
-                if line.startswith(agency_id_str + ','):
-                    parts = line.split(',')
-                    if len(parts) >= 5:
-                        new_line = f"{parts[0]},{parts[1]},{parts[2]},{parts[3]},{new_contact_mode}"
-                        new_lines.append(new_line)
-                        file_was_modified = True
-                        found_and_modified = True
-                    else: new_lines.append(line)
-                else: new_lines.append(line)
-            if file_was_modified:
-                new_content = "\n".join(new_lines)
-                content_io = io.BytesIO(new_content.encode('utf-8'))
-                ftp.cwd("/")
-                if path != "/": ftp.cwd(path)
-                ftp.storbinary(f'STOR {filename}', content_io)
-                st.info(f"ID {agency_id_str} modifié dans {path}/{filename}")
-        except Exception: pass
-    if not found_and_modified: st.warning(f"L'ID d'agence {agency_id_str} n'a pas été trouvé pour modification dans les fichiers du site '{site}'.")
-
-def verifier_parametrage_ftp(ftp, agency_id, site_choice):
-    """
-    Vérification standard sur le FTP.
-    """
-    st.info(f"Recherche de l'ID d'agence '{agency_id}' sur le FTP...")
-    
-    results_figaro = check_id_for_site(ftp, agency_id, 'figaro')
-    results_proprietes = check_id_for_site(ftp, agency_id, 'proprietes')
-    all_results = results_figaro + results_proprietes
-    
-    if all_results:
-        st.success(f"L'ID d'agence '{agency_id}' est présent :")
-        for file_path, mode in all_results:
-            mode_text = "Email Agence (0)" if mode == '0' else "Email Négociateur (1)" if mode == '1' else f"Valeur inconnue ({mode})"
-            st.write(f"- Dans **{file_path}** avec le mode : **{mode_text}**")
-        
-        # Vérification de cohérence
-        if site_choice == 'Figaro Immobilier' or site_choice == 'Les deux':
-            check_coherence(results_figaro, "Figaro Immobilier")
-        if site_choice == 'Propriétés Le Figaro' or site_choice == 'Les deux':
-            check_coherence(results_proprietes, "Propriétés Le Figaro")
-    else:
-        st.info(f"L'ID d'agence '{agency_id}' n'a été trouvé dans aucun fichier CSV.")
+@st.cache_resource
+def get_feed_mirror():
+    return FeedMirror(MIRROR_DIR)
 
+@st.cache_resource
+def get_write_coordinator():
+    """File d'écriture commune à toutes les sessions du serveur Streamlit."""
+    return WriteCoordinator(get_agency_index())
+
+@st.cache_resource
+def get_agency_index():
+    """Index commun aux sessions, à leurs préchargements et aux écritures groupées."""
+    return AgencyIndex(get_feed_mirror())
+
+def attach_script_context():
+    """Rattache les threads du moteur asynchrone au script, pour que leurs messages s'affichent."""
+    ctx = get_script_run_ctx()
+    return lambda: add_script_run_ctx(threading.current_thread(), ctx)
+
+# Les messages du moteur (notify) s'affichent avec l'élément Streamlit du même niveau
+set_event_sink(lambda level, message: getattr(st, level)(message))
 
 # --- INTERFACE UTILISATEUR ---
 st.title("Outil de gestion des flux Apimo")
@@ -249,78 +88,316 @@ st.title("Outil de gestion des flux Apimo")
 col1, col2 = st.columns(2)
 
 with col1:
-    action = st.radio("Action :", ('Ajouter', 'Supprimer', 'Vérifier', 'Modifier le mode de contact'))
-    agency_id_input = st.text_input("Agency ID :")
+    action = st.radio("Action :", ('Ajouter', 'Supprimer', 'Vérifier', 'Vérifier en masse', 'Modifier le mode de contact', 'Traitement par lot', 'Rééquilibrer', 'Migrer les fichiers scindés', 'Audit de cohérence'))
+    agency_id_input, batch_file, weights_file, id_list_input, id_list_file = "", None, None, "", None
+    if action == 'Vérifier en masse':
+        id_list_input = st.text_area("Agency ID (un par ligne ou séparés par des virgules) :")
+        id_list_file = st.file_uploader("Ou fichier d'ID (CSV/XLSX) :", type=['csv', 'xlsx'], help="Colonne agency_id, sinon la première colonne.")
+    elif action == 'Traitement par lot':
+        batch_file = st.file_uploader("Fichier du lot (CSV/XLSX) :", type=['csv', 'xlsx'], help="Colonnes : agency_id, action (ajouter/supprimer/modifier), site et contact_mode (facultatives, valeurs par défaut ci-contre).")
+    elif action in ('Rééquilibrer', 'Migrer les fichiers scindés'):
+        weights_file = st.file_uploader("Volumes d'annonces (facultatif, CSV/XLSX) :", type=['csv', 'xlsx'], help="Colonnes : agency_id, volume. Sans fichier, chaque agence compte pour une ligne.")
+    else:
+        agency_id_input = st.text_input("Agency ID :")
     ftp_password = st.text_input("Mot de passe FTP :", type="password", help="Requis pour accéder aux fichiers.")
 
 with col2:
-    site_choice = st.radio("Site(s) :", ('Figaro Immobilier', 'Propriétés Le Figaro', 'Les deux'))
+    site_choice = st.radio("Site(s) :", tuple(SITE_DISPLAY_NAMES.values()) + (ALL_SITES_LABEL,))
     contact_mode_options = {'Email Agence (0)': 0, 'Email Négociateur (1)': 1}
     
     # Le mode de contact ne sert que pour l'ajout/modif
-    if action == 'Ajouter' or action == 'Modifier le mode de contact':
+    if action in ('Ajouter', 'Modifier le mode de contact', 'Traitement par lot'):
         contact_mode = st.selectbox("Mode de contact :", options=list(contact_mode_options.keys()))
     else:
         contact_mode = None
 
+with st.sidebar:
+    use_mirror = st.checkbox("Vérifier depuis le miroir local", value=True, help="« Vérifier » et « Vérifier en masse » lisent la dernière copie des CSV enregistrée sur disque, sans connexion au FTP. Décocher pour revalider sur le serveur.")
+    use_async_engine = st.checkbox("Traiter les sites en parallèle", value=True, help="Vérification, ajout, suppression et modification : tous les fichiers puis les deux sites sont traités simultanément, avec la progression fichier par fichier. Décocher pour revenir au traitement séquentiel.")
+    use_group_commit = st.checkbox("Regrouper les écritures des sessions", value=True, help="Ajout, suppression et modification : les demandes simultanées de plusieurs opérateurs sont appliquées ensemble, avec une seule lecture et un seul envoi par fichier.")
+    use_warmup = st.checkbox("Précharger les fichiers en arrière-plan", value=True, help="Dès la saisie du mot de passe, tous les CSV sont téléchargés puis revalidés régulièrement pendant la session : « Exécuter » ne fait plus que vérifier qu'ils n'ont pas changé.")
+    split_policy = st.selectbox("Répartition des fichiers scindés :", options=list(SPLIT_POLICIES.keys()), index=list(SPLIT_POLICIES.keys()).index(DEFAULT_SPLIT_POLICY), help="Règle de choix du fichier scindé qui reçoit une nouvelle agence.")
+
+if ftp_password and use_warmup:
+    warmer = get_feed_warmer(get_ftp_pool(FTP_HOST, FTP_USER, ftp_password))
+    with st.sidebar:
+        if warmer.rejected: st.caption(f"Préchargement arrêté : {warmer.error}")
+        elif warmer.refreshed_at is None: st.caption("Préchargement des fichiers en cours...")
+        else: st.caption(f"Fichiers préchargés ({warmer.retr_count} téléchargement(s)), revalidés il y a {int(time.time() - warmer.refreshed_at)} s."
+                         + (f" Dernière erreur : {warmer.error}" if warmer.error else ""))
+elif st.session_state.get('feed_warmer') is not None:
+    st.session_state.pop('feed_warmer').stop()
+
+# --- OPÉRATIONS PAR SITE (SÉQUENTIELLES OU PARALLÈLES) ---
+
+def _ajouter_site(snapshot, site_code):
+    existing = check_id_for_site(snapshot, agency_id, site_code)
+    in_global = any(r[0] in GLOBAL_PATHS for r in existing)
+    in_split = any(r[0] not in GLOBAL_PATHS for r in existing)
+    if in_global and in_split:
+        st.warning(f"ID {agency_id} déjà configuré pour {SITE_DISPLAY_NAMES[site_code]}.")
+        return
+    ajouter_client(snapshot, agency_id, site_code, contact_mode_options[contact_mode], not in_global, not in_split, split_policy)
+
+def _supprimer_site(snapshot, site_code):
+    supprimer_client(snapshot, agency_id, site_code)
+
+def _modifier_site(snapshot, site_code):
+    modifier_client(snapshot, agency_id, site_code, contact_mode_options[contact_mode])
+
+SITE_OPERATIONS = {
+    'Ajouter': ("Traitement", _ajouter_site),
+    'Supprimer': ("Suppression", _supprimer_site),
+    'Modifier le mode de contact': ("Modification", _modifier_site),
+}
+
+GROUPED_ACTIONS = {'Ajouter': 'Ajouter', 'Supprimer': 'Supprimer', 'Modifier le mode de contact': 'Modifier'}
+
+def run_grouped(snapshot, sites, title):
+    """Opération confiée au coordinateur d'écritures : une ligne de lot, une section par site ; snapshot reçoit les transferts de l'envoi."""
+    row = {'agency_id': agency_id, 'sites': sites, 'action': GROUPED_ACTIONS[action],
+           'contact_mode': str(contact_mode_options[contact_mode]) if contact_mode else '0'}
+    coordinator = get_write_coordinator()
+    for result in coordinator.submit(get_ftp_pool(FTP_HOST, FTP_USER, ftp_password), [row], split_policy, snapshot)[0]:
+        st.subheader(f"{title} : {result['site']}")
+        message = f"ID {agency_id} : {result['résultat']}" + (f" ({result['fichiers']})" if result['fichiers'] else "")
+        if result['résultat'] in ('Ajouté', 'Supprimé', 'Modifié'): st.success(message)
+        elif result['résultat'].startswith(("Échec", "Ligne invalide")): st.error(message)
+        else: st.warning(message)
+    st.caption(f"Écritures groupées : {coordinator.request_count} demande(s) en {coordinator.flush_count} envoi(s) depuis le démarrage du serveur.")
+
+def run_per_site(snapshot, engine, sites, title, site_operation):
+    """Une section par site, remplie site après site ou en parallèle si engine est fourni."""
+    sections = {}
+    for site_code in sites:
+        sections[site_code] = st.container()
+        sections[site_code].subheader(f"{title} : {SITE_DISPLAY_NAMES[site_code]}")
+    def in_section(snapshot, site_code):
+        with sections[site_code]: site_operation(snapshot, site_code)
+    if engine is not None:
+        engine.run_sites(sites, in_section)
+    else:
+        for site_code in sites: in_section(snapshot, site_code)
+
+def progress_reporter():
+    bar = st.progress(0.0)
+    return lambda done, total, label: bar.progress(done / total, text=f"{label} terminé ({done}/{total})")
+
+def finish_trace(trace, token):
+    """Arrête la trace, l'ajoute au journal JSONL et l'affiche dans le panneau « Performance »."""
+    stop_trace(trace, token)
+    if not trace.events: return
+    try: trace.write_jsonl()
+    except OSError as e: st.caption(f"Journal de performance non écrit ({PERF_LOG_PATH}) : {e}")
+    frame = trace.frame()
+    with st.expander(f"Performance : {len(frame)} commande(s) FTP en {trace.duration:.2f} s"):
+        st.caption(f"Reçus : {frame['bytes_in'].sum()} octets, envoyés : {frame['bytes_out'].sum()} octets. "
+                   "Les durées se cumulent sur les connexions parallèles.")
+        st.markdown("**Par fonction**")
+        st.dataframe(trace.by_function(), use_container_width=True, hide_index=True)
+        st.markdown("**Par fichier**")
+        st.dataframe(trace.by_file(), use_container_width=True, hide_index=True)
+
+def show_mass_report(report):
+    """Tableau triable de la vérification en masse, décompte par statut et export CSV."""
+    st.subheader(f"Vérification de {report['agency_id'].nunique()} ID")
+    incomplete = report['statut'].isin(['global seul', 'scindé seul']).sum()
+    if incomplete: st.error(f"⚠️ {incomplete} configuration(s) INCOMPLÈTE(S).")
+    st.caption(", ".join(f"{status} : {count}" for status, count in report['statut'].value_counts().items()))
+    st.dataframe(report, use_container_width=True, hide_index=True)
+    st.download_button("Télécharger le résultat (CSV)", report.to_csv(index=False).encode('utf-8'), "verification_apimo.csv", "text/csv")
+
 # --- EXÉCUTION ---
 if st.button("Exécuter"):
     agency_id = agency_id_input.strip()
-    if not agency_id:
+    batch_rows = None
+    if action == 'Traitement par lot' and batch_file is not None:
+        try:
+            batch_rows = read_batch_file(batch_file, site_choice.lower(), contact_mode_options[contact_mode])
+        except Exception as e:
+            st.error(f"Fichier du lot illisible : {e}")
+    agency_ids = None
+    if action == 'Vérifier en masse':
+        try:
+            agency_ids = read_id_list(id_list_input, id_list_file)
+        except Exception as e:
+            st.error(f"Liste d'ID illisible : {e}")
+    weights = None
+    if weights_file is not None:
+        try:
+            weights = read_weights_file(weights_file)
+        except Exception as e:
+            st.error(f"Fichier des volumes illisible : {e}")
+    if action == 'Traitement par lot' and batch_rows is None:
+        if batch_file is None: st.error("Le fichier du lot est obligatoire.")
+    elif weights_file is not None and weights is None:
+        pass # Erreur de lecture déjà affichée
+    elif action == 'Vérifier en masse' and not agency_ids:
+        if agency_ids is not None: st.error("Au moins un Agency ID est obligatoire.")
+    elif action not in ('Vérifier en masse', 'Traitement par lot', 'Rééquilibrer', 'Migrer les fichiers scindés', 'Audit de cohérence') and not agency_id:
         st.error("L'Agency ID est obligatoire.")
     elif not ftp_password:
         st.error("Le mot de passe FTP est obligatoire.")
+    elif action in ('Vérifier', 'Vérifier en masse') and use_mirror and all(get_agency_index().has(key) for files in SITE_FILES.values() for key in files):
+        index = get_agency_index()
+        age = index.age([key for files in SITE_FILES.values() for key in files])
+        age_text = f"{int(age // 60)} min" if age >= 60 else f"{int(age)} s"
+        if age > MIRROR_MAX_AGE:
+            st.warning(f"Miroir local ancien : dernière vérification sur le serveur il y a {age_text}. Décochez « Vérifier depuis le miroir local » pour actualiser.")
+        else:
+            st.caption(f"Lecture depuis le miroir local (dernière vérification sur le serveur il y a {age_text}).")
+        snapshot = FeedSnapshot(None, index)
+        if action == 'Vérifier': verifier_parametrage_ftp(snapshot, agency_id, site_choice)
+        else: show_mass_report(verifier_en_masse(snapshot, agency_ids, sites_for_choice(site_choice)))
+        for (path, filename), error in snapshot.errors.items():
+            st.warning(f"Lecture impossible de {path}/{filename} : {error}")
     else:
         ftp = None
+        broken = False
+        trace, trace_token = start_trace(action)
         try:
             with st.spinner("Connexion au serveur FTP..."):
                 ftp = connect_ftp(FTP_HOST, FTP_USER, ftp_password)
             if ftp:
                 st.success("Connexion FTP réussie.")
                 
-                site_display_names = {'figaro': 'Figaro Immobilier', 'proprietes': 'Propriétés Le Figaro'}
+                site_display_names = SITE_DISPLAY_NAMES
                 sites_to_process = []
-                if site_choice == 'Figaro Immobilier': sites_to_process.append('figaro')
-                elif site_choice == 'Propriétés Le Figaro': sites_to_process.append('proprietes')
-                elif site_choice == 'Les deux': sites_to_process.extend(['figaro', 'proprietes'])
+                if batch_rows is not None: sites_to_process.extend(code for code in SITE_FILES if any(code in (row['sites'] or []) for row in batch_rows))
+                else: sites_to_process.extend(sites_for_choice(site_choice))
                 
+                pool = get_ftp_pool(FTP_HOST, FTP_USER, ftp_password)
+                saved_before = pool.cache.saved
+                snapshot = FeedSnapshot(ftp, get_agency_index(), pool)
+                grouped = use_group_commit and action in GROUPED_ACTIONS
+                engine = None
+                if use_async_engine and not grouped and (action == 'Vérifier' or action in SITE_OPERATIONS):
+                    engine = AsyncFeedEngine(snapshot, progress_reporter(), attach_script_context())
                 with st.spinner(f"Opération '{action}' en cours..."):
+                    files_to_load = [] if grouped else [key for site_code in sites_to_process for key in SITE_FILES[site_code]]  # lectures faites par le coordinateur
+                    if action in ('Vérifier', 'Supprimer', 'Modifier le mode de contact'): files_to_load = snapshot.use_sidecar(files_to_load)
+                    probe_id = agency_id if action in SITE_OPERATIONS or action == 'Vérifier' else None  # lecture interrompue dès l'agence trouvée
+                    if engine is not None: engine.prefetch(files_to_load, probe_id)
+                    elif action != 'Vérifier': snapshot.prefetch(files_to_load, probe_id)
                     
                     if action == 'Vérifier':
-                        verifier_parametrage_ftp(ftp, agency_id, site_choice)
+                        verifier_parametrage_ftp(snapshot, agency_id, site_choice)
 
-                    elif action == 'Ajouter':
-                        for site_code in sites_to_process:
-                            display_name = site_display_names.get(site_code, site_code.upper())
-                            st.subheader(f"Traitement : {display_name}")
-                            existing = check_id_for_site(ftp, agency_id, site_code)
-                            in_global = any("All/" in r[0] for r in existing)
-                            in_split = any("All/" not in r[0] for r in existing)
-                            if in_global and in_split:
-                                st.warning(f"ID {agency_id} déjà configuré pour {display_name}.")
-                                continue
-                            ajouter_client(ftp, agency_id, site_code, contact_mode_options[contact_mode], not in_global, not in_split)
-
-                    elif action == 'Supprimer':
-                        for site_code in sites_to_process:
-                            display_name = site_display_names.get(site_code, site_code.upper())
-                            st.subheader(f"Suppression : {display_name}")
-                            supprimer_client(ftp, agency_id, site_code)
+                    elif action == 'Vérifier en masse':
+                        show_mass_report(verifier_en_masse(snapshot, agency_ids, sites_to_process))
+
+                    elif grouped:
+                        run_grouped(snapshot, sites_to_process, SITE_OPERATIONS[action][0])
+
+                    elif action in SITE_OPERATIONS:
+                        run_per_site(snapshot, engine, sites_to_process, *SITE_OPERATIONS[action])
 
-                    elif action == 'Modifier le mode de contact':
+                    elif action == 'Traitement par lot':
+                        results = pd.DataFrame(appliquer_lot(snapshot, batch_rows, split_policy))
+                        st.subheader(f"Résultat du lot ({len(batch_rows)} ligne(s))")
+                        st.dataframe(results, use_container_width=True)
+                        st.download_button("Télécharger le résultat (CSV)", results.to_csv(index=False).encode('utf-8'), "resultat_lot.csv", "text/csv")
+
+                    elif action in ('Rééquilibrer', 'Migrer les fichiers scindés'):
+                        plan = {}
                         for site_code in sites_to_process:
-                            # CORRECTION ICI : On définit display_name avant de l'utiliser
-                            display_name = site_display_names.get(site_code, site_code.upper())
-                            st.subheader(f"Modification : {display_name}")
-                            modifier_client(ftp, agency_id, site_code, contact_mode_options[contact_mode])
-                        
+                            st.subheader(f"Plan de rééquilibrage : {site_display_names[site_code]}")
+                            orphans = find_orphan_split_files(snapshot, site_code) if action == 'Migrer les fichiers scindés' else []
+                            if orphans:
+                                st.info(f"Fichiers hors topologie à vider : {', '.join(orphans)}. Ils pourront ensuite être retirés de l'import Apimo.")
+                            moves, before, after = planifier_reequilibrage(snapshot, site_code, weights, orphans)
+                            st.dataframe(pd.DataFrame({'avant': before, 'après': after}), use_container_width=True)
+                            if moves:
+                                st.dataframe(pd.DataFrame(moves).drop(columns=['ligne']), use_container_width=True)
+                                plan[site_code] = moves
+                            else:
+                                st.info("Fichiers déjà équilibrés : aucun déplacement nécessaire.")
+                        st.session_state['rebalance_plan'] = plan
+                        if plan:
+                            st.info(f"{sum(len(m) for m in plan.values())} déplacement(s) proposé(s). Vérifiez le plan puis cliquez sur « Appliquer le plan de rééquilibrage ».")
+
+                    elif action == 'Audit de cohérence':
+                        report = pd.concat([auditer_site(snapshot, site_code) for site_code in sites_to_process], ignore_index=True)
+                        if report.empty:
+                            st.success("Aucune anomalie : toutes les agences sont cohérentes.")
+                        else:
+                            st.error(f"{len(report)} anomalie(s) sur {report['agency_id'].nunique()} agence(s).")
+                            st.dataframe(report, use_container_width=True)
+                            st.download_button("Télécharger le rapport (CSV)", report.to_csv(index=False).encode('utf-8'), "audit_apimo.csv", "text/csv")
+                        st.session_state['audit_sites'] = [code for code in sites_to_process if (report['site'] == SITE_DISPLAY_NAMES[code]).any()]
+
+                    snapshot.publish_sidecar()
+                for (path, filename), error in snapshot.errors.items():
+                    st.warning(f"Lecture impossible de {path}/{filename} : {error}")
                 st.success("Opération terminée.")
+                st.caption(f"Transferts : {snapshot.retr_count} téléchargement(s), {snapshot.stor_count} envoi(s), {snapshot.reused_count} fichier(s) inchangé(s) servi(s) par l'index."
+                           + (f" {snapshot.sidecar_count} fichier(s) servi(s) par l'index serveur." if snapshot.sidecar_count else "")
+                           + (f" {snapshot.partial_count} lecture(s) arrêtée(s) dès l'agence trouvée." if snapshot.partial_count else "")
+                           + (f" {snapshot.conflict_count} conflit(s) d'écriture résolu(s) par relecture." if snapshot.conflict_count else "")
+                           + (f" {pool.cache.saved - saved_before} aller(s)-retour(s) FTP évité(s) (répertoire courant, listes en cache)." if pool.cache.saved > saved_before else ""))
         except Exception:
+            broken = True
             st.error("Une erreur inattendue est survenue.")
             st.code(traceback.format_exc())
         finally:
-            if ftp:
-                try: ftp.quit()
-                except: pass
+            if ftp: release_ftp(ftp, discard=broken)
+            finish_trace(trace, trace_token)
+
+# --- CONFIRMATIONS (PLAN DE RÉÉQUILIBRAGE, CORRECTIONS D'AUDIT) ---
+
+def run_confirmed_operation(spinner_text, operation):
+    """Connexion, instantané et gestion d'erreur communs aux boutons de confirmation."""
+    if not ftp_password:
+        st.error("Le mot de passe FTP est obligatoire.")
+        return False
+    trace, trace_token = start_trace(action)
+    ftp = connect_ftp(FTP_HOST, FTP_USER, ftp_password)
+    if not ftp:
+        finish_trace(trace, trace_token)
+        return False
+    broken = False
+    try:
+        snapshot = FeedSnapshot(ftp, get_agency_index(), get_ftp_pool(FTP_HOST, FTP_USER, ftp_password))
+        with st.spinner(spinner_text):
+            operation(snapshot)
+            snapshot.publish_sidecar()
+        return True
+    except Exception:
+        broken = True
+        st.error("Une erreur inattendue est survenue.")
+        st.code(traceback.format_exc())
+        return False
+    finally:
+        release_ftp(ftp, discard=broken)
+        finish_trace(trace, trace_token)
+
+def _apply_rebalance_plan(snapshot):
+    snapshot.prefetch([key for site_code in pending_plan for key in SITE_FILES[site_code][1:]])
+    for site_code, moves in pending_plan.items():
+        st.subheader(f"Rééquilibrage : {SITE_DISPLAY_NAMES[site_code]}")
+        applied = appliquer_reequilibrage(snapshot, site_code, moves)
+        st.success(f"{applied} agence(s) déplacée(s).")
+
+def _apply_audit_fixes(snapshot):
+    snapshot.prefetch([key for site_code in pending_audit for key in SITE_FILES[site_code]])
+    for site_code in pending_audit:
+        fixes, failed = corriger_anomalies(snapshot, site_code, split_policy)
+        for key, error in failed.items():
+            st.error(f"Échec de l'envoi de {display_path(*key)} : {error}")
+        st.success(f"{SITE_DISPLAY_NAMES[site_code]} : {fixes} correction(s) appliquée(s).")
+
+pending_plan = st.session_state.get('rebalance_plan')
+if action in ('Rééquilibrer', 'Migrer les fichiers scindés') and pending_plan:
+    st.caption(f"Plan en attente : {sum(len(m) for m in pending_plan.values())} déplacement(s) sur {', '.join(SITE_DISPLAY_NAMES[s] for s in pending_plan)}.")
+    if st.button("Appliquer le plan de rééquilibrage"):
+        if run_confirmed_operation("Rééquilibrage en cours...", _apply_rebalance_plan):
+            del st.session_state['rebalance_plan']
+
+pending_audit = st.session_state.get('audit_sites')
+if action == 'Audit de cohérence' and pending_audit:
+    st.caption(f"Anomalies en attente de correction sur {', '.join(SITE_DISPLAY_NAMES[s] for s in pending_audit)}. Le fichier Global fait référence.")
+    if st.button("Corriger toutes les anomalies"):
+        if run_confirmed_operation("Corrections en cours...", _apply_audit_fixes):
+            del st.session_state['audit_sites']
 
 st.markdown(f"<div style='text-align: center; color: grey; font-size: 0.8em;'>Version {APP_VERSION}</div>", unsafe_allow_html=True)
\ No newline at end of file
@@ -0,0 +1,212 @@
+# benchmarks/bench_ftp.py
+"""
+Banc de mesure des opérations FTP de l'outil Apimo.
+
+Démarre un serveur FTP local (pyftpdlib) alimenté avec des apimo_*.csv générés
+selon sites.toml, puis mesure pour chaque taille de fichier Global et chaque action
+(connexion, vérification, ajout, modification, suppression) : durée, allers-retours
+sur le canal de commande, octets transférés et pic mémoire (tracemalloc, mesuré
+dans une seconde passe pour ne pas fausser les durées). Le rapport JSON peut être
+comparé à celui d'une autre version avec --compare.
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_ftp.py --sizes 1000,100000,1000000 --latency-ms 20 --bandwidth-kbps 2000 -o bench.json
+    python benchmarks/bench_ftp.py --compare ancien.json -o nouveau.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import DTPHandler, FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    sys.exit("pyftpdlib est requis : pip install -r benchmarks/requirements.txt")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import apimo_core as core  # noqa: E402
+
+logging.disable(logging.INFO)  # journal de pyftpdlib : une ligne par commande
+
+BENCH_USER, BENCH_PASSWORD = "bench", "bench"
+BENCH_AGENCY_ID = "9999999"  # absent des fichiers générés : ajouté, modifié puis supprimé
+ACTIONS = ('connect_ftp', 'check_id_for_site', 'ajouter_client', 'modifier_client', 'supprimer_client')
+
+# --- SERVEUR FTP LOCAL ---
+
+class Counters:
+    """Allers-retours et octets vus par le serveur depuis le dernier reset()."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.commands = 0
+            self.bytes_sent = 0      # serveur -> client (RETR, NLST...)
+            self.bytes_received = 0  # client -> serveur (STOR, APPE)
+
+    def add(self, commands=0, sent=0, received=0):
+        with self._lock:
+            self.commands += commands
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+def start_server(root, port, latency, bandwidth, counters):
+    """Serveur FTP en thread ; latency (s) ajoutée à chaque commande, bandwidth (octets/s, 0 = illimité)."""
+    class DTP(DTPHandler):
+        # Débit simulé par une pause après chaque bloc : chaque connexion a son propre thread
+        def use_sendfile(self):
+            return False
+
+        def send(self, data):
+            sent = super().send(data)
+            if bandwidth: time.sleep(sent / bandwidth)
+            return sent
+
+        def recv(self, buffer_size):
+            chunk = super().recv(buffer_size)
+            if bandwidth: time.sleep(len(chunk) / bandwidth)
+            return chunk
+
+        def close(self):
+            # Compté avant la réponse 226 envoyée par close() : le client n'a pas encore repris la main
+            if not self._closed: counters.add(sent=self.tot_bytes_sent, received=self.tot_bytes_received)
+            super().close()
+
+    class Handler(FTPHandler):
+        dtp_handler = DTP
+        def pre_process_command(self, line, cmd, arg):
+            counters.add(commands=1)
+            if latency: time.sleep(latency)
+            super().pre_process_command(line, cmd, arg)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(BENCH_USER, BENCH_PASSWORD, root, perm="elradfmwMT")
+    Handler.authorizer = authorizer
+    server = ThreadedFTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return server
+
+def seed_feeds(root, lines):
+    """Fichier Global de `lines` agences par site, réparties à parts égales entre les fichiers scindés."""
+    for site, files in core.SITE_FILES.items():
+        login = core.SITE_LOGINS[site]
+        records = [f"{1000000 + n},{login},{core.AGENCY_HASH},agency,{n % 2}" for n in range(lines)]
+        (global_path, global_file), splits = files[0], files[1:]
+        for path, filename, content in [(global_path, global_file, records)] + [
+                (path, filename, records[i::len(splits)]) for i, (path, filename) in enumerate(splits)]:
+            directory = os.path.join(root, path.strip('/'))
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, filename), 'w', encoding='utf-8') as f:
+                f.write("\n".join(content))
+
+# --- MESURES ---
+
+def run_actions(port, counters, measure_memory):
+    """
+    Enchaîne les actions, chacune sur une connexion ouverte hors mesure et un index
+    vide (cas le plus coûteux : tous les fichiers sont téléchargés).
+    """
+    results = {}
+    site = next(iter(core.SITE_FILES))
+    connect = lambda: core._open_ftp("127.0.0.1", BENCH_USER, BENCH_PASSWORD, port)
+    steps = {
+        'connect_ftp': lambda snapshot: connect().close(),
+        'check_id_for_site': lambda snapshot: core.check_id_for_site(snapshot, "1000000", site),
+        'ajouter_client': lambda snapshot: core.ajouter_client(snapshot, BENCH_AGENCY_ID, site, 1),
+        'modifier_client': lambda snapshot: core.modifier_client(snapshot, BENCH_AGENCY_ID, site, 0),
+        'supprimer_client': lambda snapshot: core.supprimer_client(snapshot, BENCH_AGENCY_ID, site),
+    }
+    for action in ACTIONS:
+        snapshot = None if action == 'connect_ftp' else core.FeedSnapshot(connect())
+        counters.reset()
+        if measure_memory: tracemalloc.start()
+        started = time.perf_counter()
+        steps[action](snapshot)
+        wall = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+        if measure_memory: tracemalloc.stop()
+        if snapshot is not None: snapshot.ftp.close()
+        results[action] = {'wall_s': round(wall, 4), 'round_trips': counters.commands,
+                           'bytes_sent': counters.bytes_sent, 'bytes_received': counters.bytes_received,
+                           'peak_mem_bytes': peak}
+    return results
+
+def bench_size(lines, port, latency, bandwidth, memory):
+    """Les deux passes (durées, puis mémoire) sur des fichiers fraîchement générés."""
+    counters = Counters()
+    root = tempfile.mkdtemp(prefix="apimo_bench_")
+    try:
+        seed_feeds(root, lines)
+        server = start_server(root, port, latency, bandwidth, counters)
+        try:
+            timings = run_actions(port, counters, measure_memory=False)
+            if memory:
+                seed_feeds(root, lines)
+                for action, measures in run_actions(port, counters, measure_memory=True).items():
+                    timings[action]['peak_mem_bytes'] = measures['peak_mem_bytes']
+        finally:
+            server.close_all()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return [{'lines': lines, 'action': action, **measures} for action, measures in timings.items()]
+
+def compare(report, baseline):
+    """Écart relatif (durée, allers-retours, octets) par rapport à un rapport précédent."""
+    previous = {(r['lines'], r['action']): r for r in baseline['results']}
+    print(f"Comparaison {baseline.get('app_version')} -> {report['app_version']}", file=sys.stderr)
+    for r in report['results']:
+        old = previous.get((r['lines'], r['action']))
+        if not old: continue
+        deltas = []
+        for metric in ('wall_s', 'round_trips', 'bytes_sent', 'bytes_received'):
+            if old[metric]: deltas.append(f"{metric} {100 * (r[metric] - old[metric]) / old[metric]:+.0f}%")
+            elif r[metric]: deltas.append(f"{metric} 0 -> {r[metric]}")
+        print(f"  {r['lines']:>8} lignes  {r['action']:<18} {', '.join(deltas) or 'identique'}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--sizes', default="1000,10000,100000", help="Lignes du fichier Global, séparées par des virgules (jusqu'à 1000000).")
+    parser.add_argument('--latency-ms', type=float, default=0, help="Latence ajoutée à chaque commande FTP.")
+    parser.add_argument('--bandwidth-kbps', type=int, default=0, help="Débit des transferts en Ko/s (0 = illimité).")
+    parser.add_argument('--port', type=int, default=2121)
+    parser.add_argument('--no-memory', action='store_true', help="Saute la passe de mesure mémoire.")
+    parser.add_argument('--compare', help="Rapport JSON d'une version précédente.")
+    parser.add_argument('-o', '--output', help="Fichier du rapport JSON (sortie standard par défaut).")
+    args = parser.parse_args(argv)
+
+    core.set_event_sink(lambda level, message: None)  # seuls les chiffres comptent ici
+    sizes = [int(size) for size in args.sizes.split(',')]
+    latency, bandwidth = args.latency_ms / 1000, args.bandwidth_kbps * 1024
+    results = []
+    for lines in sizes:
+        print(f"{lines} lignes...", file=sys.stderr)
+        results.extend(bench_size(lines, args.port, latency, bandwidth, not args.no_memory))
+    report = {
+        'app_version': core.APP_VERSION,
+        'python': platform.python_version(),
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'params': {'sizes': sizes, 'latency_ms': args.latency_ms, 'bandwidth_kbps': args.bandwidth_kbps},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f: compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
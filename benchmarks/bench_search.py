@@ -0,0 +1,144 @@
+# benchmarks/bench_search.py
+"""
+Micro-banc de la recherche d'une agence dans un CSV en mémoire.
+
+Compare, sur un fichier de --lines lignes généré, l'ancienne méthode (décodage,
+splitlines puis index {id: n° de ligne}) au FeedBuffer d'apimo_core (recherche
+b"\\n" + id + b"," dans les octets, retouches par plages d'octets), pour : mise
+en mémoire du contenu téléchargé, recherche d'un ID, suppression et modification
+d'une agence. Durée médiane sur --repeat passes et pic mémoire (tracemalloc).
+Les mesures sont précédées de --check fichiers aléatoires avec lignes hors format
+où les deux méthodes doivent trouver, retirer et modifier les mêmes lignes.
+Aucun serveur FTP n'est nécessaire.
+
+    python benchmarks/bench_search.py --lines 500000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import apimo_core as core  # noqa: E402
+
+# --- ANCIENNE MÉTHODE (DÉCODAGE + SPLITLINES) ---
+
+def lines_load(data):
+    lines = [line.strip() for line in data.decode('utf-8', errors='ignore').splitlines() if line.strip()]
+    ids = {}
+    for n, line in enumerate(lines): ids.setdefault(line.split(',', 1)[0], n)  # règle d'origine : line.strip().startswith(id + ',')
+    return lines, ids
+
+def lines_lookup(data, agency_id):
+    lines, ids = lines_load(data)
+    n = ids.get(agency_id)
+    return None if n is None else (n, core.parse_contact_mode(lines[n]))
+
+def lines_delete(data, agency_id):
+    lines, _ = lines_load(data)
+    return "\n".join(line for line in lines if not line.startswith(agency_id + ',')).encode('utf-8')
+
+def lines_modify(data, agency_id, mode):
+    lines, _ = lines_load(data)
+    out = []
+    for line in lines:
+        parts = line.split(',')
+        if line.startswith(agency_id + ',') and len(parts) >= 5: line = ','.join(parts[:4] + [str(mode)])
+        out.append(line)
+    return "\n".join(out).encode('utf-8')
+
+# --- FEEDBUFFER ---
+
+STEPS = {
+    'load': (lambda data, agency_id: lines_load(data),
+             lambda data, agency_id: core.FeedBuffer(data)),
+    'lookup': (lines_lookup,
+               lambda data, agency_id: core.FeedBuffer(data).find(agency_id)),
+    'delete': (lines_delete,
+               lambda data, agency_id: core.FeedBuffer(data).without(agency_id)[0].data),
+    'modify': (lambda data, agency_id: lines_modify(data, agency_id, 0),
+               lambda data, agency_id: core.FeedBuffer(data).with_contact_mode(agency_id, 0)[0].data),
+}
+
+# --- ÉQUIVALENCE SUR DES LIGNES HORS FORMAT ---
+
+def check(rounds, seed=0):
+    """
+    Fichiers aléatoires mêlant lignes au format et hors format (espaces ou tabulations
+    de tête, espace avant la virgule, zéro de tête, champs manquants ou en trop,
+    lignes vides) : FeedBuffer (recherche directe puis indexée), le filtre en flux et
+    FeedColumns doivent donner les mêmes lignes que l'ancienne méthode, et FeedColumns
+    (EditableFeed) les mêmes octets que FeedBuffer.
+    """
+    import io
+    import random
+    rng, login = random.Random(seed), next(iter(core.SITE_LOGINS.values()))
+    shapes = ["{id},{login},h,agency,{mode}", " {id},{login},h,agency,{mode}", "\t{id},{login},h,agency,{mode}  ",
+              "{id} ,{login},h,agency,{mode}", "0{id},{login},h,agency,{mode}", "{id},{login},h", "{id},{login},h,agency,x,{mode}", "", "   "]
+    for _ in range(rounds):
+        data = "\n".join(rng.choice(shapes).format(id=rng.randint(1, 6), login=login, mode=rng.randint(0, 1))
+                         for _ in range(rng.randint(0, 30))).encode('utf-8') + rng.choice([b"", b"\n"])
+        direct, indexed = core.FeedBuffer(data), core.FeedBuffer(data)
+        for _ in range(core.BUFFER_INDEX_AFTER + 1): indexed.find('0')
+        columns = core.FeedColumns.parse(direct)
+        assert [line.strip() for line in columns.lines()] == direct.lines(), data
+        assert columns.to_bytes() == b"\n".join(line for line in data.split(b"\n") if line.strip()), data  # lignes gardées octet pour octet
+        for agency_id in ('1', '2', '3', '01', '4 '):
+            expected = lines_lookup(data, agency_id)
+            removed, modified = lines_delete(data, agency_id).decode('utf-8').splitlines(), lines_modify(data, agency_id, 0).decode('utf-8').splitlines()
+            for buffer in (direct, indexed):
+                found = buffer.find(agency_id)
+                assert (found and found[1]) == (expected and expected[1]), (data, agency_id)
+                assert core.FeedBuffer(buffer.without(agency_id)[0].data).lines() == removed, (data, agency_id)
+                assert core.FeedBuffer(buffer.with_contact_mode(agency_id, 0)[0].data).lines() == modified, (data, agency_id)
+            for edit_line, lines in ((core._line_without(agency_id), removed), (core._line_with_contact_mode(agency_id, 0), modified)):
+                out = io.BytesIO()
+                stream = core._LineStream(edit_line, out)
+                for n in range(0, len(data), 7): stream(data[n:n + 7])
+                stream.close()
+                assert core.FeedBuffer(out.getvalue()).lines() == lines, (data, agency_id)
+            assert len(columns.rows(agency_id)) == sum(line.startswith(agency_id + ',') for line in direct.lines()), (data, agency_id)
+            for edit, expected_buffer in ((lambda feed: feed.remove(agency_id), direct.without(agency_id)[0]),
+                                          (lambda feed: feed.set_contact_mode(agency_id, 0), direct.with_contact_mode(agency_id, 0)[0])):
+                feed = core.EditableFeed(direct)
+                edit(feed)
+                assert feed.columns.to_bytes() == core.FeedColumns.parse(expected_buffer).to_bytes(), (data, agency_id)
+
+def measure(step, data, agency_id, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        step(data, agency_id)
+        durations.append(time.perf_counter() - started)
+    tracemalloc.start()
+    step(data, agency_id)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'wall_s': round(statistics.median(durations), 5), 'peak_mem_bytes': peak}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--lines', type=int, default=500000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--check', type=int, default=200, help="Fichiers aléatoires vérifiés avant les mesures (0 : aucun).")
+    args = parser.parse_args(argv)
+    check(args.check)
+
+    login = next(iter(core.SITE_LOGINS.values()))
+    data = "\n".join(f"{1000000 + n},{login},{core.AGENCY_HASH},agency,{n % 2}" for n in range(args.lines)).encode('utf-8')
+    agency_id = str(1000000 + args.lines * 3 // 4)  # dans le dernier quart du fichier
+    results = []
+    for name, (old, new) in STEPS.items():
+        if name in ('delete', 'modify'): assert old(data, agency_id) == new(data, agency_id), name  # mêmes octets envoyés
+        before, after = measure(old, data, agency_id, args.repeat), measure(new, data, agency_id, args.repeat)
+        results.append({'step': name, 'splitlines': before, 'feed_buffer': after})
+        print(f"{name:<7} splitlines {before['wall_s'] * 1000:8.1f} ms {before['peak_mem_bytes'] / 2**20:7.1f} Mo   "
+              f"FeedBuffer {after['wall_s'] * 1000:8.1f} ms {after['peak_mem_bytes'] / 2**20:7.1f} Mo", file=sys.stderr)
+    print(json.dumps({'app_version': core.APP_VERSION, 'lines': args.lines, 'bytes': len(data), 'results': results}, indent=2))
+
+if __name__ == "__main__":
+    main()